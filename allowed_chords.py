@@ -2,31 +2,40 @@
 most implied chords are not found in any English words
 """
 import json
+from corpus_artifact import load_corpus
 
 PRON_FREQ_FILE = "pronunciation_frequency.json"
 VOWELS = {"AA", "AE", "AH", "AO", "AW", "AY",
           "EH", "ER", "EY", "IH", "IY", "OW", "OY", "UH", "UW"}
 
 
-before_vowel = set()
-after_vowel = set()
+def vowel_cluster_sets(pronunciations):
+    before_vowel = set()
+    after_vowel = set()
 
+    for key in pronunciations:
+        pronunciation = key.split()
 
-with open(PRON_FREQ_FILE, "r") as f:
-    data = json.load(f)
+        # Find indices of vowels in this sequence
+        vowel_indices = [i for i, phoneme in enumerate(pronunciation) if phoneme in VOWELS]
 
-for key in data.keys():
-    pronunciation = key.split()
 
-    # Find indices of vowels in this sequence
-    vowel_indices = [i for i, phoneme in enumerate(pronunciation) if phoneme in VOWELS]
+        for idx in vowel_indices:
+            # Before vowel: everything up to but not including that vowel
+            if idx > 0:
+                before_vowel.add(" ".join(pronunciation[:idx]))
 
+            # After vowel: everything from that vowel onward
+            after_vowel.add(" ".join(pronunciation[idx:]))
 
-    for idx in vowel_indices:
-        # Before vowel: everything up to but not including that vowel
-        if idx > 0:
-            before_vowel.add(" ".join(pronunciation[:idx]))
-        
-        # After vowel: everything from that vowel onward
-        after_vowel.add(" ".join(pronunciation[idx:]))
+    return before_vowel, after_vowel
 
+
+# The compiled corpus already has these worked out, only go through the JSON if it's missing or out of date
+corpus = load_corpus(PRON_FREQ_FILE, VOWELS)
+if corpus is not None:
+    before_vowel, after_vowel = corpus.vowel_cluster_sets()
+else:
+    with open(PRON_FREQ_FILE, "r") as f:
+        data = json.load(f)
+    before_vowel, after_vowel = vowel_cluster_sets(data.keys())
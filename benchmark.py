@@ -0,0 +1,292 @@
+"""
+Timings for the fitness engine and the GA loop, so every speed up (or slow down) shows up as a number
+
+Every workload is fixed: the WSI layout from default_bank, random 40 gene individuals from a seeded generator,
+and one generation of a seeded population. Each one is run a few times and the fastest run is compared against
+this machine's timing baselines, anything more than --threshold times slower than its baseline counts as a regression.
+The fitnesses get checked too (against benchmark_baselines.json, and WSI coverage has to stay at 522.67),
+since a faster scorer that gives different answers is no use.
+
+python benchmark.py                 run everything, compare against the baselines, exit 1 on a regression or a changed fitness
+python benchmark.py --save          run everything and save the results as the new baselines
+python benchmark.py score_layout    just the workloads named
+
+Only the fitnesses are committed. Timings are only worth comparing on the machine they were taken on, so they go in
+.benchmark_timings.json (not committed), under this machine's name and CPU. Until there are some for this machine
+only the fitnesses get checked, run --save before starting on a change to get some
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+
+import numpy as np
+
+from default_bank import LEFT_CHORDS, RIGHT_CHORDS, LEFT_BANK_LEN, RIGHT_BANK_LEN
+from find_implied_chords import mask_to_chords, generate_masks
+import layout_fitness_measurer as lfm
+from layout_fitness_measurer import (FitnessCache, LEFT_BANK, LEFT_BANK_MASKS, RIGHT_BANK_MASKS, VOWELS,
+                                     find_vowel_split_matches, score_layout, score_individual, score_population)
+from seed_population import create_initial_population_parallel
+from evolve_population import init_worker, next_generation, score_generation
+
+BASELINE_FILE = "benchmark_baselines.json" # fitnesses, committed
+TIMINGS_FILE = ".benchmark_timings.json" # {machine: timings}, local to wherever it's run
+DEFAULT_THRESHOLD = 1.25 # slower than this many times the baseline is a regression
+FITNESS_TOLERANCE = 1e-9
+
+SEED = 2024
+RANDOM_INDIVIDUALS = 8
+RANDOM_GENES = 40
+GENERATION_POPULATION = 100
+
+WSI_COVERAGE = 522.67 # to 2 decimal places, what the WSI layout has always scored
+
+
+def wsi_individual():
+    return (
+        [{cluster: mask} for cluster, mask in LEFT_CHORDS.items()],
+        [{cluster: mask} for cluster, mask in RIGHT_CHORDS.items()],
+    )
+
+
+def random_individuals(count, genes=RANDOM_GENES, seed=SEED):
+    return create_initial_population_parallel(LEFT_BANK_LEN, RIGHT_BANK_LEN, max_chords=genes, population_size=count,
+                                              rng=np.random.default_rng(seed))
+
+
+def clear_table_caches():
+    """So every run builds the mask tables from scratch rather than timing a dictionary lookup"""
+    for cache in (lfm.LEFT_TABLE_CACHE, lfm.RIGHT_TABLE_CACHE):
+        cache.tables.clear()
+
+
+# Every workload is (setup, run): setup isn't timed and gets called before every run, whatever it returns is passed to run
+# run returns whatever fitness values should never change (or None)
+
+def mask_to_chords_workload():
+    masks = generate_masks(LEFT_BANK_LEN)[1:]
+    def run(_):
+        for mask in masks:
+            mask_to_chords(mask, LEFT_BANK_LEN, LEFT_BANK)
+    return None, run
+
+
+def find_vowel_split_matches_workload():
+    pronunciations = lfm.PRONUNCIATIONS # loaded now, not while timing
+    def run(_):
+        find_vowel_split_matches(pronunciations, VOWELS, LEFT_BANK_MASKS, RIGHT_BANK_MASKS)
+    return None, run
+
+
+def score_layout_workload():
+    pronunciations = lfm.PRONUNCIATIONS
+    matches, ambiguous = find_vowel_split_matches(pronunciations, VOWELS, LEFT_BANK_MASKS, RIGHT_BANK_MASKS)
+    def run(_):
+        scores = score_layout(matches, ambiguous, pronunciations)
+        return {"wsi_coverage": scores["coverage_prob"], "wsi_conflict_ratio": scores["conflict_ratio"]}
+    return None, run
+
+
+def score_individual_wsi_workload():
+    individual = wsi_individual()
+    def setup():
+        clear_table_caches()
+        return FitnessCache()
+    def run(cache):
+        return {"wsi_fitness": score_individual(individual, cache)}
+    return setup, run
+
+
+def score_individual_random_workload():
+    individuals = random_individuals(RANDOM_INDIVIDUALS)
+    def setup():
+        clear_table_caches()
+        for individual in individuals:
+            individual.fitness = None
+        return FitnessCache()
+    def run(cache):
+        return {"random_fitnesses": [score_individual(individual, cache) for individual in individuals]}
+    return setup, run
+
+
+def score_population_random_workload():
+    individuals = random_individuals(RANDOM_INDIVIDUALS)
+    def setup():
+        clear_table_caches()
+        for individual in individuals:
+            individual.fitness = None
+        return FitnessCache()
+    def run(cache):
+        return {"random_fitnesses": score_population(individuals, cache)}
+    return setup, run
+
+
+class InlinePool:
+    def starmap(self, func, iterable):
+        return [func(*args) for args in iterable]
+
+
+def generation_step_workload():
+    """One generation as evolve_population does it (select, breed, mutate, score the children), scored in this process
+    so the number doesn't depend on how many cores there are. Starts from an already scored population"""
+    population = random_individuals(GENERATION_POPULATION, seed=SEED + 1)
+    init_worker(FitnessCache())
+    score_generation(InlinePool(), population, {}, 1)
+    fitnesses = [ind.fitness for ind in population]
+
+    def setup():
+        clear_table_caches()
+        init_worker(FitnessCache())
+        random.seed(SEED)
+        return [ind.copy() for ind in population]
+    def run(generation):
+        new_population, child_parents = next_generation(generation, fitnesses, len(generation))
+        scored = score_generation(InlinePool(), new_population, child_parents, 1)
+        return {"generation_fitness_sum": math.fsum(scored)}
+    return setup, run
+
+
+WORKLOADS = {
+    "mask_to_chords": mask_to_chords_workload,
+    "find_vowel_split_matches": find_vowel_split_matches_workload,
+    "score_layout": score_layout_workload,
+    "score_individual_wsi": score_individual_wsi_workload,
+    "score_individual_random": score_individual_random_workload,
+    "score_population_random": score_population_random_workload,
+    "generation_step": generation_step_workload,
+}
+
+REPEATS = {"generation_step": 5, "find_vowel_split_matches": 5}
+DEFAULT_REPEATS = 9
+
+
+def time_workload(name, repeats=None):
+    """(fastest, median, fitness values) over the runs"""
+    setup, run = WORKLOADS[name]()
+    times = []
+    values = None
+    for i in range(repeats or REPEATS.get(name, DEFAULT_REPEATS)):
+        state = setup() if setup is not None else None
+        start = time.perf_counter()
+        result = run(state)
+        times.append(time.perf_counter() - start)
+        if values is None:
+            values = result
+        elif result != values:
+            raise RuntimeError(f"{name} gave different fitnesses on different runs: {values} then {result}")
+    return min(times), statistics.median(times), values or {}
+
+
+def fitnesses_match(expected, actual):
+    if isinstance(expected, list):
+        return isinstance(actual, list) and len(expected) == len(actual) and all(map(fitnesses_match, expected, actual))
+    return math.isclose(expected, actual, rel_tol=FITNESS_TOLERANCE, abs_tol=FITNESS_TOLERANCE)
+
+
+def machine_key():
+    """Which timings to compare against, the same host with the same CPU"""
+    return f"{platform.node()}/{platform.processor() or platform.machine()}/{os.cpu_count()}"
+
+
+def load_json(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_json(data, path):
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def load_baselines(path=BASELINE_FILE, timings_path=TIMINGS_FILE):
+    """{"fitness": the committed fitnesses, "timings": this machine's timings (empty if it hasn't got any)}"""
+    return {
+        "fitness": load_json(path).get("fitness", {}),
+        "timings": load_json(timings_path).get(machine_key(), {}),
+    }
+
+
+def run_benchmarks(names, baselines, threshold=DEFAULT_THRESHOLD, repeats=None):
+    """Times every workload in names, prints a table against the baselines
+    Returns (timings, fitness values, list of problems)"""
+    timings = {}
+    fitness = {}
+    problems = []
+
+    if not baselines["timings"]:
+        print(f"No timing baselines for {machine_key()} yet, only checking fitnesses (--save to take some)")
+    print(f"{'workload':<26} {'fastest':>10} {'median':>10} {'baseline':>10} {'ratio':>7}")
+    for name in names:
+        fastest, median, values = time_workload(name, repeats)
+        timings[name] = fastest
+        fitness.update(values)
+
+        baseline = baselines["timings"].get(name)
+        if baseline:
+            ratio = fastest / baseline
+            flag = "  SLOWER" if ratio > threshold else ""
+            print(f"{name:<26} {fastest * 1e3:>8.2f}ms {median * 1e3:>8.2f}ms {baseline * 1e3:>8.2f}ms {ratio:>6.2f}x{flag}")
+            if ratio > threshold:
+                problems.append(f"{name} took {fastest * 1e3:.2f}ms, {ratio:.2f}x its baseline of {baseline * 1e3:.2f}ms")
+        else:
+            print(f"{name:<26} {fastest * 1e3:>8.2f}ms {median * 1e3:>8.2f}ms {'-':>10} {'-':>7}")
+
+    for key, value in fitness.items():
+        expected = baselines["fitness"].get(key)
+        if expected is not None and not fitnesses_match(expected, value):
+            problems.append(f"{key} changed from {expected} to {value}")
+    if "wsi_coverage" in fitness and round(fitness["wsi_coverage"], 2) != WSI_COVERAGE:
+        problems.append(f"WSI coverage is {fitness['wsi_coverage']:.2f}, it should be {WSI_COVERAGE}")
+
+    return timings, fitness, problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the fitness engine and GA loop against stored baselines")
+    parser.add_argument("workloads", nargs="*", help=f"any of {', '.join(WORKLOADS)} (default all of them)")
+    parser.add_argument("--save", action="store_true",
+                        help=f"save the fitnesses to {BASELINE_FILE} and this machine's timings to {TIMINGS_FILE} as the new baselines")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="how many times slower than the baseline counts as a regression")
+    parser.add_argument("--repeats", type=int, help="runs per workload, the fastest one counts")
+    parser.add_argument("--baselines", default=BASELINE_FILE)
+    parser.add_argument("--timings", default=TIMINGS_FILE)
+    args = parser.parse_args(argv)
+
+    names = args.workloads or list(WORKLOADS)
+    unknown = [name for name in names if name not in WORKLOADS]
+    if unknown:
+        parser.error(f"unknown workload(s) {unknown}, expected some of {list(WORKLOADS)}")
+
+    baselines = load_baselines(args.baselines, args.timings)
+    timings, fitness, problems = run_benchmarks(names, baselines, args.threshold, args.repeats)
+
+    if args.save:
+        # the fitnesses have to be right before they become what everything else gets checked against
+        wrong_coverage = [p for p in problems if p.startswith("WSI coverage")]
+        if wrong_coverage:
+            print(wrong_coverage[0])
+            return 1
+        baselines["fitness"].update(fitness)
+        save_json({"fitness": baselines["fitness"]}, args.baselines)
+        all_timings = load_json(args.timings)
+        all_timings.setdefault(machine_key(), {}).update(timings)
+        save_json(all_timings, args.timings)
+        print(f"Saved fitnesses to {args.baselines} and timings for {machine_key()} to {args.timings}")
+        return 0
+
+    for problem in problems:
+        print(problem)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
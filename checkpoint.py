@@ -0,0 +1,206 @@
+"""
+Checkpoints for long evolve_population runs, so a SLURM job that gets preempted or runs out of time can pick up where it left off
+
+A checkpoint is taken at the top of a generation, before anything's been scored, and has everything the loop needs to carry on
+exactly as if it had never stopped: the population (with the fitnesses survivors carry), which parent each child gets scored from,
+the generation counter, the state of the random module and, with screening on, the survivor cutoff children get screened against.
+Optionally the fitness cache goes in too, so nothing has to be rescored.
+
+It's a single .npz of flat arrays (the genomes are already arrays), the arrays get copied on the main process and
+written out on a background thread, to a temporary file that's renamed into place once it's complete,
+so a job killed halfway through a write never leaves a broken checkpoint behind
+"""
+import os
+import random
+import re
+import threading
+import zipfile
+from array import array
+
+import numpy as np
+
+from genome import Genome, CLUSTER_NAMES, intern_cluster
+
+CHECKPOINT_PATTERN = re.compile(r"^checkpoint_(\d+)\.npz$")
+VERSION = 1
+
+
+def checkpoint_name(generation):
+    return f"checkpoint_{generation:06d}.npz"
+
+
+def population_arrays(population):
+    """Every genome's genes back to back, along with where each one starts, its split and its fitness (nan if it hasn't got one)"""
+    lengths = np.array([len(ind.clusters) for ind in population], dtype=np.int64)
+    clusters = np.concatenate([np.frombuffer(ind.clusters, dtype=np.uint32) for ind in population]) if population else np.zeros(0, np.uint32)
+    masks = np.concatenate([np.frombuffer(ind.masks, dtype=np.uint16) for ind in population]) if population else np.zeros(0, np.uint16)
+
+    # cluster ids only mean something in this process, so the names of every one used go along with them
+    used = np.unique(clusters)
+    return {
+        "starts": np.concatenate(([0], np.cumsum(lengths))),
+        "splits": np.array([ind.split for ind in population], dtype=np.int64),
+        "fitnesses": np.array([np.nan if ind.fitness is None else ind.fitness for ind in population], dtype=np.float64),
+        "clusters": clusters,
+        "masks": masks,
+        "cluster_ids": used,
+        "cluster_names": np.array([CLUSTER_NAMES[i] for i in used], dtype=str),
+    }
+
+
+def population_from_arrays(arrays):
+    # map the saved ids onto this process's ids by name
+    remap = np.zeros(int(arrays["cluster_ids"].max(initial=0)) + 1, dtype=np.uint32)
+    for cluster_id, name in zip(arrays["cluster_ids"].tolist(), arrays["cluster_names"].tolist()):
+        remap[cluster_id] = intern_cluster(name)
+    clusters = remap[arrays["clusters"]] if len(arrays["clusters"]) else arrays["clusters"]
+
+    population = []
+    starts = arrays["starts"].tolist()
+    for i, (start, end) in enumerate(zip(starts, starts[1:])):
+        fitness = float(arrays["fitnesses"][i])
+        genome = Genome(
+            array("I", clusters[start:end].astype(np.uint32).tobytes()),
+            array("H", arrays["masks"][start:end].astype(np.uint16).tobytes()),
+            int(arrays["splits"][i]),
+            None if np.isnan(fitness) else fitness,
+        )
+        population.append(genome)
+    return population
+
+
+def random_state_arrays(state):
+    version, internal, gauss_next = state
+    return {
+        "random_version": np.array(version, dtype=np.int64),
+        "random_internal": np.array(internal, dtype=np.int64),
+        "random_gauss": np.array(np.nan if gauss_next is None else gauss_next, dtype=np.float64),
+    }
+
+
+def random_state_from_arrays(arrays):
+    gauss_next = float(arrays["random_gauss"])
+    return (
+        int(arrays["random_version"]),
+        tuple(int(x) for x in arrays["random_internal"]),
+        None if np.isnan(gauss_next) else gauss_next,
+    )
+
+
+class Checkpoint:
+    """What a checkpoint held, ready to hand to evolve_population as resume"""
+
+    def __init__(self, generation, population, child_parents, random_state, cache_snapshot=None, path=None, screen_cutoff=None):
+        self.generation = generation # the generation to start from, nothing in it has been scored yet
+        self.population = population
+        self.child_parents = child_parents # {index in population: parent}, same as evolve_population keeps
+        self.random_state = random_state
+        self.cache_snapshot = cache_snapshot
+        self.path = path
+        self.screen_cutoff = screen_cutoff # what the generation's children get screened against (None if they weren't)
+
+    def restore_cache(self, cache):
+        """Put the saved fitnesses back in cache, if there were any and the cache knows how to take them"""
+        if self.cache_snapshot is not None and hasattr(cache, "restore"):
+            cache.restore(self.cache_snapshot)
+
+
+def load_checkpoint(path):
+    with np.load(path, allow_pickle=False) as data:
+        arrays = {name: data[name] for name in data.files}
+
+    if int(arrays["version"]) != VERSION:
+        raise ValueError(f"{path} is from a different checkpoint version")
+
+    population = population_from_arrays(arrays)
+    child_parents = {
+        int(child): population[int(parent)]
+        for child, parent in zip(arrays["child_indices"], arrays["parent_indices"])
+    }
+    cache_snapshot = None
+    if "cache_hashes" in arrays:
+        cache_snapshot = {name[len("cache_"):]: value for name, value in arrays.items() if name.startswith("cache_")}
+
+    # checkpoints from before screening existed don't have one
+    screen_cutoff = float(arrays["screen_cutoff"]) if "screen_cutoff" in arrays else np.nan
+
+    return Checkpoint(int(arrays["generation"]), population, child_parents, random_state_from_arrays(arrays), cache_snapshot, path,
+                      None if np.isnan(screen_cutoff) else screen_cutoff)
+
+
+class Checkpointer:
+    def __init__(self, directory, every=10, keep=3, include_cache=False):
+        """Writes a checkpoint into directory every `every` generations, keeping the newest `keep` of them
+        include_cache saves the fitness cache as well, which makes them bigger but means nothing gets rescored after a resume"""
+        self.directory = directory
+        self.every = every
+        self.keep = keep
+        self.include_cache = include_cache
+        self.writer = None
+        self.error = None
+        os.makedirs(directory, exist_ok=True)
+
+    def checkpoints(self):
+        """(generation, path) of every checkpoint in the directory, oldest first"""
+        found = []
+        for name in os.listdir(self.directory):
+            match = CHECKPOINT_PATTERN.match(name)
+            if match:
+                found.append((int(match.group(1)), os.path.join(self.directory, name)))
+        return sorted(found)
+
+    def load_latest(self):
+        """The newest checkpoint that loads, or None if there isn't one"""
+        for generation, path in reversed(self.checkpoints()):
+            try:
+                return load_checkpoint(path)
+            except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+                print(f"Skipping checkpoint {path}: {e}")
+        return None
+
+    def maybe_save(self, generation, population, child_parents, cache=None, screen_cutoff=None):
+        if self.every and generation % self.every == 0:
+            self.save(generation, population, child_parents, cache, screen_cutoff)
+
+    def save(self, generation, population, child_parents, cache=None, screen_cutoff=None):
+        """Copy everything now (the GA carries on changing it), then write it out in the background
+        screen_cutoff is the survivor cutoff this generation's children are to be screened against, if screening's on"""
+        arrays = population_arrays(population)
+        arrays.update(random_state_arrays(random.getstate()))
+        positions = {id(ind): i for i, ind in enumerate(population)}
+        children = sorted(child_parents)
+        arrays["child_indices"] = np.array(children, dtype=np.int64)
+        arrays["parent_indices"] = np.array([positions[id(child_parents[i])] for i in children], dtype=np.int64)
+        arrays["generation"] = np.array(generation, dtype=np.int64)
+        arrays["version"] = np.array(VERSION, dtype=np.int64)
+        arrays["screen_cutoff"] = np.array(np.nan if screen_cutoff is None else screen_cutoff, dtype=np.float64)
+        if self.include_cache and cache is not None and hasattr(cache, "snapshot"):
+            arrays.update({f"cache_{name}": value for name, value in cache.snapshot().items()})
+
+        # only one write at a time, if the last one's still going this waits for it
+        self.wait()
+        self.writer = threading.Thread(target=self._write, args=(generation, arrays), daemon=True)
+        self.writer.start()
+
+    def _write(self, generation, arrays):
+        path = os.path.join(self.directory, checkpoint_name(generation))
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.savez(f, **arrays)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            for _, old_path in self.checkpoints()[:-self.keep]:
+                os.remove(old_path)
+        except OSError as e:
+            self.error = e
+
+    def wait(self):
+        """Block until the checkpoint being written (if any) is on disk"""
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            print(f"Writing a checkpoint failed: {error}")
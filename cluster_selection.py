@@ -1,6 +1,8 @@
 import json
 import random
 
+import numpy as np
+
 with open("initial_clusters.json") as f:
     INITIAL_CLUSTERS = json.load(f)
     INITIAL_KEYS = list(INITIAL_CLUSTERS.keys())
@@ -30,3 +32,45 @@ def select_final_cluster():
         length = random.randint(1, len(parts))
         parts = parts[-length:]   # keep END
     return " ".join(parts)
+
+
+TRUNCATE_PROBABILITY = 0.3
+
+
+class ClusterSampler:
+    """select_initial_cluster/select_final_cluster for a whole batch at once with a numpy Generator
+    The cumulative weights are worked out once, and every cluster a draw can come out as (each key, and each piece of it
+    that can be kept) gets a place in self.names, so a batch of draws is a few array operations giving indices into it"""
+
+    def __init__(self, keys, weights, keep):
+        """keep is "start" (initial clusters keep their start when cut short) or "end" (final clusters keep their end)"""
+        self.cumulative = np.cumsum(np.asarray(weights, dtype=np.float64))
+        self.part_counts = np.array([len(key.split()) for key in keys], dtype=np.int64)
+        # key k cut down to length l is names[offsets[k] + l - 1]
+        self.offsets = np.concatenate(([0], np.cumsum(self.part_counts)[:-1]))
+        self.names = []
+        for key in keys:
+            parts = key.split()
+            for length in range(1, len(parts) + 1):
+                self.names.append(" ".join(parts[:length] if keep == "start" else parts[-length:]))
+        self.ids = None
+
+    def draw(self, rng, size):
+        """size indices into self.names, distributed the same as calling select_initial_cluster/select_final_cluster size times"""
+        keys = np.searchsorted(self.cumulative, rng.random(size) * self.cumulative[-1], side="right")
+        keys = np.minimum(keys, len(self.cumulative) - 1) # in case rounding puts one right on the end
+        part_counts = self.part_counts[keys]
+        truncate = (part_counts > 1) & (rng.random(size) < TRUNCATE_PROBABILITY)
+        lengths = np.where(truncate, rng.integers(1, part_counts + 1), part_counts)
+        return self.offsets[keys] + lengths - 1
+
+    def draw_ids(self, rng, size):
+        """Same as draw, but as interned cluster ids (every one of self.names is a static cluster, so these are the same in every process)"""
+        if self.ids is None:
+            from genome import intern_cluster
+            self.ids = np.array([intern_cluster(name) for name in self.names], dtype=np.uint32)
+        return self.ids[self.draw(rng, size)]
+
+
+INITIAL_SAMPLER = ClusterSampler(INITIAL_KEYS, INITIAL_WEIGHTS, keep="start")
+FINAL_SAMPLER = ClusterSampler(FINAL_KEYS, FINAL_WEIGHTS, keep="end")
@@ -0,0 +1,228 @@
+"""
+The pronunciation corpus compiled into one binary file, so a process can map it in instead of parsing the JSON
+and splitting every pronunciation at every vowel all over again
+
+Every worker (and every job on the cluster) was doing that at import time, and it's the same work every time.
+The file is a small JSON header followed by raw arrays, so loading it is an mmap and some views, and every process
+that maps it shares the same pages.
+
+The header keeps a digest of the JSON it was built from, if the JSON has changed since (or the file's missing)
+load_corpus returns None and everything falls back to reading the JSON like before.
+Rebuild it with: python corpus_artifact.py
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+ARTIFACT_FILE = "pronunciation_frequency.corpus"
+MAGIC = b"PRONCRPS"
+VERSION = 1 # bump this whenever what goes into the file changes
+ALIGN = 64
+
+
+def source_digest(json_path):
+    with open(json_path, "rb") as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+
+def artifact_path(json_path):
+    return os.path.join(os.path.dirname(json_path), ARTIFACT_FILE)
+
+
+def encode_strings(strings):
+    # newline can't show up in a pronunciation, a cluster or a word, so it ends each one (the empty cluster is "\n")
+    return np.frombuffer("".join(s + "\n" for s in strings).encode("utf-8"), dtype=np.uint8)
+
+
+def decode_strings(blob):
+    return blob.tobytes().decode("utf-8").split("\n")[:-1]
+
+
+class CorpusArtifact:
+    """A loaded artifact, the arrays are read only views into the mapped file"""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} isn't a corpus artifact")
+            header_len = int.from_bytes(f.read(8), "little")
+            self.header = json.loads(f.read(header_len))
+        self.path = path
+        self.built = {}
+        self.data = np.memmap(path, dtype=np.uint8, mode="r")
+        self.arrays = {}
+        for name, (offset, dtype, length) in self.header["arrays"].items():
+            size = length * np.dtype(dtype).itemsize
+            # plain ndarray views, indexing a memmap subclass is noticeably slower
+            self.arrays[name] = np.asarray(self.data[offset:offset + size]).view(dtype)
+
+    def strings(self, name):
+        return decode_strings(self.arrays[name])
+
+    def pronunciations(self):
+        """{pronunciation: {word: zipf}}, the same as the JSON it came from, in the same order"""
+        if "pronunciations" not in self.built:
+            self.built["pronunciations"] = self._pronunciations()
+        return self.built["pronunciations"]
+
+    def _pronunciations(self):
+        words = self.strings("words")
+        zipfs = self.arrays["word_zipf"].tolist()
+        starts = self.arrays["word_start"].tolist()
+        return {
+            pron: dict(zip(words[start:end], zipfs[start:end]))
+            for pron, start, end in zip(self.strings("prons"), starts, starts[1:])
+        }
+
+    def vowel_splits(self):
+        """The same tuples build_vowel_splits would give"""
+        if "vowel_splits" not in self.built:
+            self.built["vowel_splits"] = self._vowel_splits()
+        return self.built["vowel_splits"]
+
+    def _vowel_splits(self):
+        prons = self.strings("prons")
+        lefts = self.strings("left_clusters")
+        rights = self.strings("right_clusters")
+        vowels = self.strings("vowels")
+        weights = self.arrays["pron_weight"].tolist()
+        return [
+            (lefts[left], vowels[vowel], rights[right], prons[pron], weights[pron])
+            for left, vowel, right, pron in zip(
+                self.arrays["split_left"].tolist(), self.arrays["split_vowel"].tolist(),
+                self.arrays["split_right"].tolist(), self.arrays["split_pron"].tolist()
+            )
+        ]
+
+    def corpus_arrays(self):
+        from vectorised_scoring import CorpusArrays
+
+        def ids(name):
+            return {s: i for i, s in enumerate(self.strings(name))}
+
+        a = self.arrays
+        return CorpusArrays(
+            a["split_left"], a["split_vowel"], a["split_right"], a["split_pron"],
+            a["pron_weight"], a["word_prob"], a["word_start"],
+            ids("prons"), ids("left_clusters"), ids("right_clusters"), ids("vowels")
+        )
+
+    def vowel_cluster_sets(self):
+        """(before_vowel, after_vowel) as allowed_chords works them out"""
+        return set(self.strings("before_vowel")), set(self.strings("after_vowel"))
+
+
+# Both allowed_chords and layout_fitness_measurer ask for it, the file only needs checking and mapping once per process
+_loaded = {}
+
+def load_corpus(json_path, vowels):
+    """The artifact for json_path, or None if there isn't an up to date one"""
+    key = (os.path.abspath(json_path), frozenset(vowels))
+    if key not in _loaded:
+        _loaded[key] = _load(json_path, vowels)
+    return _loaded[key]
+
+
+def _load(json_path, vowels):
+    path = artifact_path(json_path)
+    if not os.path.exists(path):
+        return None
+    try:
+        artifact = CorpusArtifact(path)
+    except (OSError, ValueError) as e:
+        print(f"Couldn't read {path} ({e}), using {json_path} instead")
+        return None
+
+    header = artifact.header
+    if header.get("version") != VERSION or header.get("vowels") != sorted(vowels):
+        print(f"{path} was built differently, using {json_path} instead (rebuild it with python corpus_artifact.py)")
+        return None
+    if header.get("source_digest") != source_digest(json_path):
+        print(f"{path} is out of date, using {json_path} instead (rebuild it with python corpus_artifact.py)")
+        return None
+    return artifact
+
+
+def build_artifact(json_path, vowels, path=None):
+    """Compile json_path into the artifact, written to a temporary file first so nobody maps a half written one"""
+    # only needed when building, and they'd import this module back
+    from layout_fitness_measurer import build_vowel_splits, zipf_to_prob
+    from vectorised_scoring import CorpusArrays
+    from allowed_chords import vowel_cluster_sets
+
+    if path is None:
+        path = artifact_path(json_path)
+
+    with open(json_path, "r", encoding="utf-8") as f:
+        pronunciations = json.load(f)
+    corpus = CorpusArrays.from_splits(build_vowel_splits(pronunciations, vowels), pronunciations, zipf_to_prob)
+    before_vowel, after_vowel = vowel_cluster_sets(pronunciations)
+
+    words, word_zipf = [], []
+    for word_freqs in pronunciations.values():
+        words.extend(word_freqs)
+        word_zipf.extend(word_freqs.values())
+
+    arrays = {
+        "split_left": corpus.split_left.astype(np.int32),
+        "split_vowel": corpus.split_vowel.astype(np.int32),
+        "split_right": corpus.split_right.astype(np.int32),
+        "split_pron": corpus.split_pron.astype(np.int32),
+        "pron_weight": corpus.pron_weight.astype(np.float64),
+        "word_prob": corpus.word_prob.astype(np.float64),
+        "word_start": corpus.word_start.astype(np.int64),
+        "word_zipf": np.array(word_zipf, dtype=np.float64),
+        # the ids dicts were filled in order, so their keys are already in id order
+        "prons": encode_strings(corpus.pron_ids),
+        "left_clusters": encode_strings(corpus.left_ids),
+        "right_clusters": encode_strings(corpus.right_ids),
+        "vowels": encode_strings(corpus.vowel_ids),
+        "words": encode_strings(words),
+        "before_vowel": encode_strings(sorted(before_vowel)),
+        "after_vowel": encode_strings(sorted(after_vowel)),
+    }
+
+    # lay the arrays out back to back, each starting on an aligned offset from the start of the file
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = [offset, array.dtype.str, len(array)]
+        offset += -(-array.nbytes // ALIGN) * ALIGN
+    # the offsets are relative to the data until the header length is known, which depends on the offsets
+    header_len = 0
+    while True:
+        data_start = -(-(len(MAGIC) + 8 + header_len) // ALIGN) * ALIGN
+        header = json.dumps({
+            "version": VERSION,
+            "source_digest": source_digest(json_path),
+            "vowels": sorted(vowels),
+            "arrays": {name: [data_start + o, dtype, length] for name, (o, dtype, length) in layout.items()},
+        }).encode("utf-8")
+        if len(header) <= header_len:
+            break
+        header_len = len(header)
+    header = header.ljust(header_len)
+
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(header_len.to_bytes(8, "little"))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + layout[name][0])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+    _loaded.clear()
+    return path
+
+
+if __name__ == "__main__":
+    import time
+    from layout_fitness_measurer import PRON_FREQ_FILE, VOWELS
+
+    start = time.time()
+    path = build_artifact(PRON_FREQ_FILE, VOWELS)
+    print(f"Wrote {path} ({os.path.getsize(path) / 1e6:.1f} MB) in {time.time() - start:.2f}s")
@@ -0,0 +1,93 @@
+"""
+How diverse the whole population is, cheaply enough to work out every generation
+
+calculate_similarity compares every pair of gene sets, which is O(n^2) so it only ever got a sample of 50.
+Here every individual gets a MinHash signature instead: for each of a few random hash functions, the smallest hash of any of its genes.
+Two individuals have the same minimum for a hash function with probability equal to their Jaccard similarity,
+so the average similarity over every pair comes from counting, per hash function, how many individuals share each minimum,
+which is O(n) rather than O(n^2)
+
+Gene entropy is per position in the genome: how spread out the (cluster, mask) genes at that position are across the population,
+0 bits when everyone has the same gene there
+"""
+import numpy as np
+
+NUM_HASHES = 128
+HASH_SEED = 0x5EED
+
+
+def gene_matrices(population):
+    """(clusters, masks, split) as n x genes arrays, every genome has to be the same length (breed needs that anyway)"""
+    lengths = {len(ind.clusters) for ind in population}
+    if len(lengths) != 1:
+        raise ValueError(f"Genomes have different lengths: {sorted(lengths)}")
+    clusters = np.array([np.frombuffer(ind.clusters, dtype=np.uint32) for ind in population], dtype=np.uint64)
+    masks = np.array([np.frombuffer(ind.masks, dtype=np.uint16) for ind in population], dtype=np.uint64)
+    return clusters, masks, population[0].split
+
+
+def gene_keys(clusters, masks, split):
+    """One integer per gene, (cluster, which bank, mask), the same thing individual_to_set puts in its set"""
+    bank = np.zeros(clusters.shape[1], dtype=np.uint64)
+    bank[split:] = 1
+    return (clusters << np.uint64(17)) | (bank << np.uint64(16)) | masks
+
+
+def minhash_signatures(keys, num_hashes=NUM_HASHES, seed=HASH_SEED):
+    """n x num_hashes, the smallest hash of each individual's genes under each hash function
+    The hash functions are multiply-shift (a * key + b, top 32 bits, wrapping at 64 bits) with odd a"""
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 2**63, size=num_hashes, dtype=np.uint64) | np.uint64(1)
+    b = rng.integers(0, 2**63, size=num_hashes, dtype=np.uint64)
+
+    # most genes are shared, so only hash each distinct one, then look the hashes up for every individual
+    unique_keys, gene_index = np.unique(keys, return_inverse=True)
+    gene_index = gene_index.reshape(keys.shape)
+    # one row per hash function, so each lookup reads from one contiguous row
+    hashed = ((a[:, None] * unique_keys + b[:, None]) >> np.uint64(32)).astype(np.uint32)
+
+    signatures = np.empty((keys.shape[0], num_hashes), dtype=np.uint32)
+    for h in range(num_hashes):
+        signatures[:, h] = hashed[h][gene_index].min(axis=1)
+    return signatures
+
+
+def column_runs(matrix):
+    """Sorts each column and finds its runs of equal values, (column of each run, length of each run)"""
+    ordered = np.sort(matrix, axis=0).T
+    starts = np.ones(ordered.shape, dtype=bool)
+    starts[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    start_positions = np.flatnonzero(starts)
+    lengths = np.diff(np.append(start_positions, ordered.size))
+    return start_positions // ordered.shape[1], lengths
+
+
+def minhash_similarity(signatures):
+    """Estimated average Jaccard similarity over every pair of individuals
+    For each hash function, the pairs that agree are the pairs within each group of equal minimums"""
+    n = signatures.shape[0]
+    if n < 2:
+        return 1.0
+    _, lengths = column_runs(signatures)
+    agreeing_pairs = int((lengths * (lengths - 1) // 2).sum())
+    return agreeing_pairs / (signatures.shape[1] * n * (n - 1) // 2)
+
+
+def gene_entropy(clusters, masks):
+    """Shannon entropy in bits of the genes at each position across the population"""
+    alleles = (clusters << np.uint64(16)) | masks
+    columns, lengths = column_runs(alleles)
+    p = lengths / alleles.shape[0]
+    return np.bincount(columns, weights=-p * np.log2(p), minlength=alleles.shape[1])
+
+
+def population_diversity(population, num_hashes=NUM_HASHES):
+    """{"similarity": estimated average pairwise Jaccard, "entropy": mean gene entropy, "gene_entropy": per position}"""
+    clusters, masks, split = gene_matrices(population)
+    signatures = minhash_signatures(gene_keys(clusters, masks, split), num_hashes)
+    entropy = gene_entropy(clusters, masks)
+    return {
+        "similarity": minhash_similarity(signatures),
+        "entropy": float(entropy.mean()),
+        "gene_entropy": entropy,
+    }
@@ -0,0 +1,294 @@
+"""
+Scoring spread over several nodes instead of one Pool on one node
+
+The GA's process runs a coordinator (a multiprocessing manager listening on a TCP port), and any number of worker processes,
+on this node or others, connect to it, pull tasks, score them with the usual layout_fitness_measurer/incremental_scoring code
+and push the results back. Workers send a heartbeat every few seconds, if one goes quiet for too long whatever it was working on
+goes back in the queue for someone else.
+
+RemotePool has the same starmap as a Pool, so evolve_population can use it in place of its local Pool.
+
+Tasks and results travel as pickles and workers run whatever function they're sent, so anyone who can connect can run
+code on the GA's node and every worker. There's no default authkey because of that, EVALUATION_AUTHKEY has to be set
+(to something long and random) on every node, and the coordinator only listens on 127.0.0.1 unless EVALUATION_HOST says otherwise.
+Only open it up on a network the cluster's nodes have to themselves.
+
+On the GA's node:       EVALUATION_PORT=50000 EVALUATION_HOST=<its cluster address> EVALUATION_AUTHKEY=... python main.py
+On every worker node:   EVALUATION_AUTHKEY=... python evaluation_server.py worker <ga node>:50000 [processes]
+"""
+import os
+import pickle
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from multiprocessing import Process, cpu_count
+from multiprocessing.managers import BaseManager
+
+HEARTBEAT_INTERVAL = 5 # seconds between a worker's heartbeats
+HEARTBEAT_TIMEOUT = 30 # seconds without one before a worker counts as lost
+POLL_INTERVAL = 0.02 # seconds to wait before asking again when there's nothing to do / nothing finished
+
+DEFAULT_HOST = "127.0.0.1" # only this node, unless EVALUATION_HOST says otherwise
+
+
+def authkey_from_env():
+    key = os.environ.get("EVALUATION_AUTHKEY")
+    if not key:
+        raise RuntimeError("EVALUATION_AUTHKEY isn't set, the coordinator and its workers won't run without one "
+                           "(anyone who can connect can run code on them)")
+    return key.encode()
+
+
+def host_from_env():
+    return os.environ.get("EVALUATION_HOST", DEFAULT_HOST)
+
+
+class Coordinator:
+    """Lives in the manager's server process, everyone else talks to it through a proxy
+    Tasks and results are kept as pickled bytes, so the server never has to import the scoring code to pass them along"""
+
+    def __init__(self, heartbeat_timeout=HEARTBEAT_TIMEOUT):
+        self.heartbeat_timeout = heartbeat_timeout
+        self.lock = threading.Lock()
+        self.tasks = {} # task id: pickled (func, args), until its result is in
+        self.pending = deque() # task ids nobody's working on
+        self.in_flight = {} # task id: worker id
+        self.results = {} # task id: pickled result, until it's collected
+        self.last_seen = {} # worker id: time of its last heartbeat
+        self.next_task_id = 0
+        self.next_worker_id = 0
+        self.redispatched = 0
+
+    def register_worker(self):
+        with self.lock:
+            worker_id = self.next_worker_id
+            self.next_worker_id += 1
+            self.last_seen[worker_id] = time.monotonic()
+            return worker_id
+
+    def heartbeat(self, worker_id):
+        with self.lock:
+            self.last_seen[worker_id] = time.monotonic()
+
+    def submit(self, payloads):
+        with self.lock:
+            task_ids = list(range(self.next_task_id, self.next_task_id + len(payloads)))
+            self.next_task_id += len(payloads)
+            for task_id, payload in zip(task_ids, payloads):
+                self.tasks[task_id] = payload
+                self.pending.append(task_id)
+            return task_ids
+
+    def get_task(self, worker_id):
+        """(task id, payload) for the worker to do next, or None if there's nothing waiting"""
+        with self.lock:
+            self.last_seen[worker_id] = time.monotonic()
+            self._requeue_lost()
+            while self.pending:
+                task_id = self.pending.popleft()
+                if task_id in self.tasks and task_id not in self.results:
+                    self.in_flight[task_id] = worker_id
+                    return task_id, self.tasks[task_id]
+            return None
+
+    def put_result(self, worker_id, task_id, result):
+        with self.lock:
+            self.last_seen[worker_id] = time.monotonic()
+            # a worker that was given up on might still finish, whichever result comes in first is kept
+            if task_id in self.tasks and task_id not in self.results:
+                self.results[task_id] = result
+            self.in_flight.pop(task_id, None)
+
+    def collect(self, task_ids):
+        """{task id: pickled result} for whichever of task_ids have finished, they're forgotten about after this"""
+        with self.lock:
+            self._requeue_lost()
+            done = {}
+            for task_id in task_ids:
+                if task_id in self.results:
+                    done[task_id] = self.results.pop(task_id)
+                    del self.tasks[task_id]
+            return done
+
+    def _requeue_lost(self):
+        now = time.monotonic()
+        lost = {worker_id for worker_id, seen in self.last_seen.items() if now - seen > self.heartbeat_timeout}
+        if not lost:
+            return
+        for worker_id in lost:
+            del self.last_seen[worker_id]
+        for task_id, worker_id in list(self.in_flight.items()):
+            if worker_id in lost:
+                del self.in_flight[task_id]
+                # to the front, these have been waiting longest
+                self.pending.appendleft(task_id)
+                self.redispatched += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "workers": len(self.last_seen),
+                "pending": len(self.pending),
+                "in_flight": len(self.in_flight),
+                "redispatched": self.redispatched,
+            }
+
+
+# The one Coordinator, made in the manager's server process when it starts
+server_coordinator = None
+
+def init_coordinator(heartbeat_timeout):
+    global server_coordinator
+    server_coordinator = Coordinator(heartbeat_timeout)
+
+def get_coordinator():
+    return server_coordinator
+
+
+class CoordinatorManager(BaseManager):
+    pass
+
+CoordinatorManager.register("coordinator", callable=get_coordinator)
+
+
+class EvaluationServer:
+    def __init__(self, address=(DEFAULT_HOST, 50000), authkey=None, heartbeat_timeout=HEARTBEAT_TIMEOUT):
+        """address is the (host, port) to listen on, port 0 picks a free one (see .address once it's started)
+        authkey defaults to EVALUATION_AUTHKEY, and there's no running without one"""
+        self.heartbeat_timeout = heartbeat_timeout
+        self.manager = CoordinatorManager(address=address, authkey=authkey or authkey_from_env())
+
+    def start(self):
+        self.manager.start(init_coordinator, (self.heartbeat_timeout,))
+        self.coordinator = self.manager.coordinator()
+        return self
+
+    @property
+    def address(self):
+        return self.manager.address
+
+    def pool(self, poll_interval=POLL_INTERVAL):
+        return RemotePool(self.coordinator, poll_interval)
+
+    def shutdown(self):
+        self.manager.shutdown()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
+class RemotePool:
+    """The part of a Pool that evolve_population uses, but the work goes out to whichever workers are connected"""
+
+    def __init__(self, coordinator, poll_interval=POLL_INTERVAL):
+        self.coordinator = coordinator
+        self.poll_interval = poll_interval
+
+    def workers(self):
+        """How many workers are connected right now (at least 1, so there's something to size chunks by)"""
+        return max(1, self.coordinator.stats()["workers"])
+
+    def starmap(self, func, iterable):
+        payloads = [pickle.dumps((func, args), protocol=pickle.HIGHEST_PROTOCOL) for args in iterable]
+        if not payloads:
+            return []
+        task_ids = self.coordinator.submit(payloads)
+
+        results = {}
+        while len(results) < len(task_ids):
+            done = self.coordinator.collect([task_id for task_id in task_ids if task_id not in results])
+            if not done:
+                time.sleep(self.poll_interval)
+            for task_id, result in done.items():
+                status, value = pickle.loads(result)
+                if status == "error":
+                    raise RuntimeError(f"Remote task failed:\n{value}")
+                results[task_id] = value
+        return [results[task_id] for task_id in task_ids]
+
+
+def connect(address, authkey=None):
+    manager = CoordinatorManager(address=address, authkey=authkey or authkey_from_env())
+    manager.connect()
+    return manager.coordinator()
+
+
+def send_heartbeats(address, authkey, worker_id, stop):
+    # its own connection, so a long task on the main thread doesn't hold the heartbeats up
+    coordinator = connect(address, authkey)
+    while not stop.wait(HEARTBEAT_INTERVAL):
+        try:
+            coordinator.heartbeat(worker_id)
+        except (EOFError, OSError):
+            return
+
+
+def worker_loop(address, authkey=None, shared_cache=None):
+    """Pull tasks from the coordinator at address and push back the results, until the coordinator goes away"""
+    from evolve_population import init_worker
+    from layout_fitness_measurer import FitnessCache
+    init_worker(shared_cache if shared_cache is not None else FitnessCache())
+    if shared_cache is not None:
+        # every worker on the node counts its cache hits into a row of its own (init_worker has already claimed it, this keeps it)
+        shared_cache.claim_stats_row()
+
+    coordinator = connect(address, authkey)
+    worker_id = coordinator.register_worker()
+    stop = threading.Event()
+    threading.Thread(target=send_heartbeats, args=(address, authkey, worker_id, stop), daemon=True).start()
+
+    try:
+        while True:
+            task = coordinator.get_task(worker_id)
+            if task is None:
+                time.sleep(POLL_INTERVAL)
+                continue
+            task_id, payload = task
+            try:
+                func, args = pickle.loads(payload)
+                result = ("ok", func(*args))
+            except Exception:
+                result = ("error", traceback.format_exc())
+            coordinator.put_result(worker_id, task_id, pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+    except (EOFError, OSError):
+        pass # the coordinator's shut down, so the run's over
+    finally:
+        stop.set()
+
+
+def run_workers(address, processes=None, authkey=None):
+    """Start `processes` workers on this node, sharing one fitness cache between them, and wait for them to finish"""
+    from shared_fitness_cache import SharedFitnessCache
+
+    # checked here, before anything starts, rather than in every worker
+    authkey = authkey or authkey_from_env()
+
+    shared_cache = SharedFitnessCache(capacity=1 << 16)
+    workers = [Process(target=worker_loop, args=(address, authkey, shared_cache)) for _ in range(processes or cpu_count())]
+    try:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        shared_cache.close()
+
+
+def parse_address(text):
+    host, port = text.rsplit(":", 1)
+    return host, int(port)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] != "worker":
+        print("usage: python evaluation_server.py worker HOST:PORT [processes]")
+        sys.exit(1)
+    run_workers(parse_address(sys.argv[2]), int(sys.argv[3]) if len(sys.argv) > 3 else None)
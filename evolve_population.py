@@ -1,8 +1,17 @@
 import random
-import copy
 import os
-from cluster_selection import select_initial_cluster, select_final_cluster
-from layout_fitness_measurer import score_individual, score_individual_detailed, FitnessCache
+import time
+from contextlib import nullcontext
+from array import array
+import numpy as np
+from cluster_selection import select_initial_cluster, select_final_cluster, INITIAL_SAMPLER, FINAL_SAMPLER
+from genome import Genome, as_genome, intern_cluster
+from layout_fitness_measurer import score_population, score_individual_detailed, FitnessCache
+from incremental_scoring import score_families, SCREEN_TOP_K
+from diversity import population_diversity
+from selection import RankSelector, generator_from_random
+from telemetry import NO_TELEMETRY
+from surrogate import Surrogate, rank_correlation
 from multiprocessing import Pool,cpu_count
 from tqdm import tqdm
 
@@ -11,78 +20,52 @@ from multiprocessing import Manager
 
 
 
-def select_survivors(population, fitnesses, survival_rate=0.5):
-    #Ranking first, then selecting. Roulette wheel style
-    number_of_survivors = int(len(population) * survival_rate)
-
-    # Pair individuals with their fitnesses and sort
-    sorted_pop = sorted(zip(population, fitnesses), key=lambda x: x[1], reverse=True)
+SURVIVAL_RATE = 0.5
+GENES_TO_MUTATE = 3 # per child
 
-    # Weighted sampling using the sorted order
-    individuals_sorted = [p for p, f in sorted_pop]
-    weights = [len(sorted_pop) - i for i in range(len(sorted_pop))]
 
-    keyed = [(random.random() ** (1.0 / w), p, f) 
-             for (p, f), w in zip(sorted_pop, weights)]
-    keyed.sort(reverse=True, key=lambda x: x[0])
+def select_survivors(population, fitnesses, survival_rate=SURVIVAL_RATE):
+    #Ranking first, then selecting. Roulette wheel style, weighted by rank and without replacement
+    number_of_survivors = int(len(population) * survival_rate)
 
     # Return survivors WITH their fitnesses
-    survivors = [(p, f) for _, p, f in keyed[:number_of_survivors]]
-    return survivors
+    return RankSelector(population, fitnesses).survivors(number_of_survivors)
 
 
-def select_parents(survivors, survivor_fitnesses):
+def select_parents(survivors, survivor_fitnesses, method="roulette"):
     #Select two parents from survivors using rank-based weighted sampling.
-    
-    # Rank survivors by fitness
-    sorted_survivors = [p for p, f in sorted(zip(survivors, survivor_fitnesses), key=lambda x: x[1], reverse=True)]
-
-    # Assign rank-based weights: top survivor gets highest weight
-    weights = [len(sorted_survivors) - i for i in range(len(sorted_survivors))]
-
-    # Weighted sampling without replacement for 2 parents
-    keyed = [(random.random() ** (1.0 / w), p) for w, p in zip(weights, sorted_survivors)]
-    keyed.sort(reverse=True, key=lambda x: x[0])
-
-    return keyed[0][1], keyed[1][1]
+    #Only for one pair, next_generation draws all of its pairs from a single RankSelector
+    return RankSelector(survivors, survivor_fitnesses).parent_pairs(1, method)[0]
 
 def breed(parent1, parent2, num_crossover_points=4):
-    # I know there are two halves, but I'll squish them together so it's just one chromosome with 4 crossover points
-    p1 = parent1[0] + parent1[1]
-    p2 = parent2[0] + parent2[1]
+    # The two halves are already squished together in the genome, so it's just one chromosome with 4 crossover points
+    p1 = parent1
+    p2 = parent2
 
-    length = len(p1)
-    assert length == len(p2), "Parents must have the same chromosome length"
+    length = len(p1.clusters)
+    assert length == len(p2.clusters), "Parents must have the same chromosome length"
 
 
     #Pick crossover locations
     points = sorted(random.sample(range(1, length), num_crossover_points))
 
-    child = []
+    # Slicing the arrays copies them, so the child never shares anything with a parent
+    clusters = array('I')
+    masks = array('H')
     take_from_p1 = True #default, start with genes from first parent
     last_point = 0
 
-    # alternate segments between parents
-    for point in points:
-        if take_from_p1:
-            child.extend(p1[last_point:point])
-        else:
-            child.extend(p2[last_point:point])
+    # alternate segments between parents, then the final segment
+    for point in points + [length]:
+        parent = p1 if take_from_p1 else p2
+        clusters.extend(parent.clusters[last_point:point])
+        masks.extend(parent.masks[last_point:point])
 
         take_from_p1 = not take_from_p1 #alternate
         last_point = point
 
-    # final segment
-    if take_from_p1:
-        child.extend(p1[last_point:])
-    else:
-        child.extend(p2[last_point:])
-
     # Re-split into 2 sections of 30 genes each
-    child_section1 = child[:int(len(child)/2)]
-    child_section2 = child[int(len(child)/2):]
-
-    return (child_section1, child_section2)
+    return Genome(clusters, masks, length // 2)
 
 
 def swap_gene(child):
@@ -101,32 +84,26 @@ def swap_gene(child):
 
 def new_mask(child):
     half = random.choice([0, 1])
-    gene_index = random.randrange(len(child[half]))
+    genes = child.half_range(half)
+    gene_index = genes[random.randrange(len(genes))]
 
     # get the existing gene
-    gene = child[half][gene_index]
-    cluster, mask = next(iter(gene.items()))
+    mask = child.masks[gene_index]
+    mask_length = child.bank_len(half)
 
-    mask_list = list(mask)  #make it a list of characters
-
-    # flip 1 or 2 bits
+    # flip 1 or 2 bits (position 0 is the leftmost key, which is the highest bit)
     bits_to_flip = random.choice([1, 2])
-    positions = random.sample(range(len(mask_list)), bits_to_flip)
+    positions = random.sample(range(mask_length), bits_to_flip)
     for pos in positions:
-        mask_list[pos] = '1' if mask_list[pos] == '0' else '0'
-
-    # convert back to string
-    new_mask_str = ''.join(mask_list)
+        mask ^= 1 << (mask_length - 1 - pos)
 
-    child[half][gene_index] = {cluster: new_mask_str}
+    child.set_gene(gene_index, child.clusters[gene_index], mask)
     return child
 
 def new_cluster(child):
     half = random.choice([0, 1])
-    gene_index = random.randrange(len(child[half]))
-
-    gene = child[half][gene_index]
-    cluster, mask = next(iter(gene.items()))
+    genes = child.half_range(half)
+    gene_index = genes[random.randrange(len(genes))]
 
     # pick new cluster based on half
     if half == 0:
@@ -135,7 +112,7 @@ def new_cluster(child):
         new_cluster_str = select_final_cluster()
 
     # assign new cluster with same mask
-    child[half][gene_index] = {new_cluster_str: mask}
+    child.set_gene(gene_index, intern_cluster(new_cluster_str), child.masks[gene_index])
 
     return child
 
@@ -148,14 +125,165 @@ def mutate(child, genes_to_mutate):
     return child
 
 
+def mutate_children(children, genes_to_mutate, rng=None):
+    """mutate for every child of a generation at once: the genes stacked into arrays, and each round of new_mask/new_cluster
+    (one gene per child, either method with even odds) done with a handful of array operations using a numpy generator
+    The children have to be the same length, which they are coming out of breed"""
+    if not children:
+        return children
+    if rng is None:
+        rng = generator_from_random()
+    split = children[0].split
+    clusters = np.array([np.frombuffer(child.clusters, dtype=np.uint32) for child in children])
+    masks = np.array([np.frombuffer(child.masks, dtype=np.uint16) for child in children], dtype=np.int64)
+    n, length = clusters.shape
+    rows = np.arange(n)
+    bank_lens = np.array(Genome.BANK_LENS)
+
+    for i in range(genes_to_mutate):
+        half = rng.integers(0, 2, size=n)
+        genes = np.where(half == 0, 0, split) + rng.integers(0, np.where(half == 0, split, length - split))
+        use_new_mask = rng.random(n) < 0.5
+
+        # new_mask: flip 1 or 2 different bits (position 0 is the leftmost key, which is the highest bit)
+        width = bank_lens[half]
+        first = rng.integers(0, width)
+        second = (first + rng.integers(1, width)) % width
+        flips = (1 << (width - 1 - first)) | np.where(rng.random(n) < 0.5, 1 << (width - 1 - second), 0)
+        masks[rows, genes] ^= np.where(use_new_mask, flips, 0)
+
+        # new_cluster: a new cluster from that half's distribution, same mask
+        new_clusters = np.where(half == 0, INITIAL_SAMPLER.draw_ids(rng, n), FINAL_SAMPLER.draw_ids(rng, n))
+        clusters[rows, genes] = np.where(use_new_mask, clusters[rows, genes], new_clusters)
+
+    return [Genome.from_rows(clusters[i], masks[i], split) for i in range(n)]
+
+
+def closest_parent(child, parent1, parent2):
+    """Whichever parent shares the most genes (in place) with the child, that's the one to score it from"""
+    return parent1 if child.shared_genes(parent1) >= child.shared_genes(parent2) else parent2
+
+
+def chunked(items, chunk_size):
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+
+def chunk_size_for(task_count, workers, chunks_per_worker=4):
+    """Big enough that the per task overhead doesn't matter, small enough that every worker gets a few to balance out"""
+    return max(1, -(-task_count // (workers * chunks_per_worker)))
+
+
+def chunked_by_size(items, sizes, workers, chunks_per_worker=4):
+    """chunked, but going by how much work is in each item (children in a family) rather than how many items there are,
+    so a chunk of big families isn't several times the work of a chunk of small ones"""
+    target = chunk_size_for(sum(sizes), workers, chunks_per_worker)
+    chunks = []
+    chunk, size = [], 0
+    for item, item_size in zip(items, sizes):
+        chunk.append(item)
+        size += item_size
+        if size >= target:
+            chunks.append(chunk)
+            chunk, size = [], 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def score_generation(pool, population, child_parents, workers, telemetry=NO_TELEMETRY, screen_cutoff=None, screen_top_k=SCREEN_TOP_K,
+                     cache=None):
+    """Score everyone, children get scored from their closest parent in families so the worker only builds the parent once
+    child_parents is {index in population: parent}, anyone not in it (the first generation) is scored from scratch
+    and survivors already carry their fitness, so they don't get sent anywhere
+    Both go to the workers in chunks rather than one at a time, through telemetry so it can time them
+
+    Only one of every layout gets sent, a child that's the same as someone already in the population (or another child)
+    just gets their fitness, which matters once the population has converged and breeding keeps coming up with the same layouts.
+    With a cache, everything left is looked up in one go here first, so only the ones that really need scoring go anywhere
+
+    With a screen_cutoff, children are screened on the screen_top_k most likely pronunciations first, and the ones that
+    can't reach the cutoff only get an upper bound on their fitness. That's what they get ranked by,
+    but they're left without a fitness of their own, so if one survives anyway it gets scored properly next generation"""
+    fitnesses = [ind.fitness for ind in population]
+
+    #every layout that needs a fitness, and everywhere it turns up
+    known = {}
+    positions = {}
+    for i, ind in enumerate(population):
+        if fitnesses[i] is not None:
+            known.setdefault(ind.key(), fitnesses[i])
+        else:
+            positions.setdefault(ind.key(), []).append(i)
+    for key in [key for key in positions if key in known]:
+        for i in positions.pop(key):
+            fitnesses[i] = known[key]
+    duplicates = sum(len(places) - 1 for places in positions.values())
+
+    cache_hits = 0
+    if cache is not None and positions:
+        keys = list(positions)
+        for key, fitness in zip(keys, cache.get_many([population[positions[key][0]] for key in keys])):
+            if fitness is not None:
+                cache_hits += 1
+                for i in positions.pop(key):
+                    fitnesses[i] = fitness
+    looked_up = cache is not None
+
+    #one of each to score, a child if there is one so it can be scored from its parent
+    to_score = {}
+    for key, places in positions.items():
+        to_score[next((i for i in places if i in child_parents), places[0])] = places
+    telemetry.count(duplicates=duplicates, cache_hits=cache_hits, dispatched=len(to_score))
+
+    singles = [i for i in to_score if i not in child_parents]
+    single_chunks = chunked(singles, chunk_size_for(len(singles), workers))
+    chunk_fitnesses = telemetry.starmap(pool, score_population,
+                                        [([population[i] for i in chunk], None, None, looked_up) for chunk in single_chunks])
+    for chunk, scores in zip(single_chunks, chunk_fitnesses):
+        for i, fitness in zip(chunk, scores):
+            for j in to_score[i]:
+                fitnesses[j] = fitness
+
+    families = {}
+    for i in to_score:
+        if i in child_parents:
+            parent = child_parents[i]
+            families.setdefault(id(parent), (parent, []))[1].append(i)
+    family_list = list(families.values())
+    family_chunks = chunked_by_size(family_list, [len(children) for _, children in family_list], workers)
+    chunk_fitnesses = telemetry.starmap(
+        pool, score_families,
+        [([(parent, [population[i] for i in children]) for parent, children in chunk], None, screen_cutoff, screen_top_k, looked_up)
+         for chunk in family_chunks])
+    screened = set()
+    for chunk, chunk_scores in zip(family_chunks, chunk_fitnesses):
+        for (parent, children), scores in zip(chunk, chunk_scores):
+            for i, fitness in zip(children, scores):
+                if screen_cutoff is not None:
+                    fitness, exact = fitness
+                    if not exact:
+                        screened.update(to_score[i])
+                for j in to_score[i]:
+                    fitnesses[j] = fitness
+
+    for i, (ind, fitness) in enumerate(zip(population, fitnesses)):
+        ind.fitness = None if i in screened else fitness
+    return fitnesses
+
+
+def evaluations_per_hour(evaluations, seconds):
+    return evaluations * 3600 / seconds if seconds > 0 else 0.0
+
+
+def survivor_cutoff(population_fitnesses, survival_rate=SURVIVAL_RATE):
+    """The fitness of the last individual that would survive if survival just went by rank, what screening has to beat"""
+    number_of_survivors = max(1, int(len(population_fitnesses) * survival_rate))
+    return sorted(population_fitnesses, reverse=True)[number_of_survivors - 1]
+
+
 def individual_to_set(individual):
-    # Gene is just a string {'K': '1111100'} -> 'K 1111100'
-    s = set()
-    for part in individual:
-        for d in part:
-            label, bits = list(d.items())[0]
-            s.add(f"{label} {bits}")
-    return s
+    # Gene is just (which bank, cluster id, mask), the same as 'K 1111100' was for {'K': '1111100'}
+    return as_genome(individual).gene_set()
 
 
 def jaccard_similarity(set_a, set_b):
@@ -182,33 +310,162 @@ def calculate_similarity(population):
 
     return total / count
 
-worker_cache = None
-
-def init_worker(shared_dict):
-    global worker_cache
-    worker_cache = FitnessCache(shared_dict)
+def format_cache_stats(stats):
+    parts = []
+    if "hit_rate" in stats:
+        parts.append(f"hit rate={stats['hit_rate']:.1%} ({stats['hits']}/{stats['hits'] + stats['misses']})")
+    if "evictions" in stats:
+        parts.append(f"evictions={stats['evictions']}")
+    parts.append(f"entries={stats['entries']}")
+    if "memory_bytes" in stats:
+        parts.append(f"load={stats['load']:.1%} of {stats['memory_bytes'] / 2**20:.1f}MB")
+    return ", ".join(parts)
+
+
+def next_generation(population, population_fitnesses, population_size, selection="roulette", telemetry=NO_TELEMETRY,
+                    surrogate=None, oversample=1, survival_rate=SURVIVAL_RATE, genes_to_mutate=GENES_TO_MUTATE):
+    """Survivors of this generation and their children, along with {index in the new population: closest parent} for scoring the children
+    selection is how parents get picked, one of selection.METHODS
+    With a trained surrogate (a surrogate.Surrogate), oversample times as many children get bred and it picks which ones make it"""
+    with telemetry.phase("selection"):
+        survivor_position_and_fitnesses = select_survivors(population, population_fitnesses, survival_rate=survival_rate)
+
+        #sorry, even if they survive, they might not breed unless they're healthy enough
+        survivors = [p for p, f in survivor_position_and_fitnesses]
+        survivor_fitnesses = [f for p, f in survivor_position_and_fitnesses]
+        #print(survivors)
+
+        new_population = survivors.copy()
+        child_parents = {}
+        needed = population_size - len(new_population)
+        use_surrogate = surrogate is not None and surrogate.trained and oversample > 1
+        #rank the survivors once and draw every pair of parents the generation needs in one go
+        parent_pairs = RankSelector(survivors, survivor_fitnesses).parent_pairs(needed * oversample if use_surrogate else needed, selection)
+
+    with telemetry.phase("breeding"):
+        #The children get their own arrays, so mutating them never touches a parent
+        children = mutate_children([breed(parent1, parent2) for parent1, parent2 in parent_pairs], genes_to_mutate)
+
+    if use_surrogate:
+        with telemetry.phase("surrogate"):
+            #only the ones the surrogate likes (and a few it doesn't) get scored properly
+            chosen = surrogate.choose(children, needed, generator_from_random())
+            children = [children[i] for i in chosen]
+            parent_pairs = [parent_pairs[i] for i in chosen]
+
+    with telemetry.phase("breeding"):
+        for child, (parent1, parent2) in zip(children, parent_pairs):
+            #print(f"child: {child}")
+
+            #remember who it's closest to, so it can be scored starting from that parent
+            child_parents[len(new_population)] = closest_parent(child, parent1, parent2)
+            new_population.append(child)
+
+    return new_population, child_parents
 
 
+worker_cache = None
 
-def evolve_population(population, number_of_iterations, population_size, shared_cache: FitnessCache):
+def init_worker(shared_cache):
+    #Either a FitnessCache around a Manager dict, or a SharedFitnessCache that reattaches to its shared memory
+    global worker_cache
+    worker_cache = shared_cache
+    if hasattr(worker_cache, "claim_stats_row"):
+        worker_cache.claim_stats_row()
+
+
+
+def evolve_population(population, number_of_iterations, population_size, shared_cache: FitnessCache, checkpointer=None, resume=None,
+                      evaluator=None, telemetry=None, screen_top_k=None, surrogate_oversample=None,
+                      survival_rate=SURVIVAL_RATE, genes_to_mutate=GENES_TO_MUTATE):
+    """checkpointer (a checkpoint.Checkpointer) saves the state every so often, and resume (a checkpoint.Checkpoint)
+    carries on from one, in which case population is ignored
+    evaluator is something to score with instead of a local Pool, like evaluation_server.RemotePool
+    telemetry (a telemetry.Telemetry) gets a line written for every generation
+    screen_top_k turns on multi-fidelity scoring, children are screened against last generation's survivor cutoff
+    on that many of the most likely pronunciations before anything else (see score_generation)
+    surrogate_oversample turns on the surrogate, every generation breeds that many times the children it needs
+    and a model trained on everything scored so far picks which ones get scored (see surrogate.py)
+    survival_rate is the share of each generation that lives on to the next, genes_to_mutate how many genes each child has mutated"""
+    if telemetry is None:
+        telemetry = NO_TELEMETRY
+    #not checkpointed, after a resume it just learns again from the population it starts with
+    surrogate = Surrogate() if surrogate_oversample and surrogate_oversample > 1 else None
     #num_cpus = int(os.environ.get("SLURM_CPUS_PER_TASK", 1)) #for running on the cluster
     #Importing only now because fitness_cache is None before main.py assigns the real cache
     #from layout_fitness_measurer import fitness_cache #commented out because it's now passed through as a variable
 
-    #with Pool(processes=num_cpus, maxtasksperchild = 200, initializer=init_worker, initargs=(shared_cache.cache,)) as pool: #for running on the cluster
-    with Pool(processes=cpu_count(), maxtasksperchild=200, initializer=init_worker, initargs=(shared_cache.cache,)) as pool: #for running locally
-        for generation in tqdm(range(number_of_iterations), desc="Evolving generations", unit="gen"):
-            population_fitnesses = pool.starmap(
-                score_individual,
-                [(ind, None) for ind in population]) #had to switch to starmap now that I'm passing in cache as well as score
-
-
-            #complexity is n^2 so I'm just doing a subset
-            sample = random.sample(population, min(len(population), 50))
-            similarity = calculate_similarity(sample)
+    #with Pool(processes=num_cpus, maxtasksperchild = 200, initializer=init_worker, initargs=(shared_cache,)) as pool: #for running on the cluster
+    if evaluator is None:
+        workers = cpu_count()
+        pool_context = Pool(processes=workers, maxtasksperchild=200, initializer=init_worker, initargs=(shared_cache,)) #for running locally
+        #the workers share this cache, so it can be checked here before anything gets sent to them
+        lookup_cache = shared_cache
+    else:
+        #the workers are somewhere else and look after themselves
+        workers = evaluator.workers()
+        pool_context = nullcontext(evaluator)
+        #remote nodes keep their own caches, so they're left to check those themselves
+        lookup_cache = None
+
+    with pool_context as pool:
+        if resume is None:
+            population = [as_genome(ind) for ind in population]
+            child_parents = {} #the first generation has no parents to score from
+            start_generation = 0
+        else:
+            #pick up exactly where the checkpoint was taken, including the random state so it carries on the same way
+            population = resume.population
+            child_parents = resume.child_parents
+            start_generation = resume.generation
+            random.setstate(resume.random_state)
+            resume.restore_cache(shared_cache)
+        #nothing to screen against until a generation's been scored, unless the checkpoint kept the cutoff it was going to use
+        screen_cutoff = resume.screen_cutoff if resume is not None and screen_top_k else None
+        evaluations = 0 #everyone who needed a fitness, to compare against steady_state's evaluations per hour
+        start = time.perf_counter()
+
+        for generation in tqdm(range(start_generation, number_of_iterations), desc="Evolving generations", unit="gen",
+                               initial=start_generation, total=number_of_iterations):
+            if evaluator is not None:
+                workers = evaluator.workers() #remote workers can come and go
+            telemetry.start_generation(generation, workers)
+            if checkpointer is not None and generation != start_generation:
+                with telemetry.phase("checkpoint"):
+                    checkpointer.maybe_save(generation, population, child_parents, shared_cache, screen_cutoff)
+
+            pending = sum(ind.fitness is None for ind in population)
+            population_fitnesses = score_generation(pool, population, child_parents, workers, telemetry,
+                                                    screen_cutoff, screen_top_k or SCREEN_TOP_K, lookup_cache)
+            screened = sum(ind.fitness is None for ind in population)
+            evaluations += pending
+            if screen_top_k:
+                screen_cutoff = survivor_cutoff(population_fitnesses, survival_rate)
+
+            correlation = None
+            if surrogate is not None:
+                with telemetry.phase("surrogate"):
+                    #everyone scored properly this generation, survivors were learnt from when they were scored
+                    fresh = [ind for i, ind in enumerate(population) if ind.fitness is not None and (i in child_parents or not child_parents)]
+                    if surrogate.trained and child_parents and len(fresh) > 1:
+                        #how well it ranked them before it got to see their fitness
+                        correlation = rank_correlation(surrogate.predict(fresh), [ind.fitness for ind in fresh])
+                    surrogate.update(fresh, [ind.fitness for ind in fresh])
+
+            #MinHash over the whole population, calculate_similarity is n^2 so it only ever got a sample
+            with telemetry.phase("diversity"):
+                diversity = population_diversity(population)
 
             #Write it to the progress bar
-            tqdm.write(f"Generation {generation}: best={max(population_fitnesses)}, avg={sum(population_fitnesses)/len(population_fitnesses)}, similarity={similarity}")
+            best = max(population_fitnesses)
+            avg = sum(population_fitnesses)/len(population_fitnesses)
+            cache_stats = shared_cache.generation_stats()
+            tqdm.write(f"Generation {generation}: best={best}, avg={avg}, similarity={diversity['similarity']:.4f}, entropy={diversity['entropy']:.3f}")
+            tqdm.write(f"    cache: {format_cache_stats(cache_stats)}")
+            if screen_top_k:
+                tqdm.write(f"    screened out: {screened}, survivor cutoff: {screen_cutoff}")
+            if correlation is not None:
+                tqdm.write(f"    surrogate rank correlation: {correlation:.3f} (trained on {surrogate.samples})")
 
             """
             kill 50% the population, biased towards keeping the healthiest alive (but some element of randomness)
@@ -218,40 +475,34 @@ def evolve_population(population, number_of_iterations, population_size, shared_
             breed the survivors together, with a chance of gene mutation
             """
 
-            survivor_position_and_fitnesses = select_survivors(population, population_fitnesses, survival_rate=0.5)
-
-            #sorry, even if they survive, they might not breed unless they're healthy enough
-            survivors = [p for p, f in survivor_position_and_fitnesses]
-            survivor_fitnesses = [f for p, f in survivor_position_and_fitnesses]
-            #print(survivors)
-
-            new_population = survivors.copy()
-            while len(new_population) < population_size:
-
-                parent1, parent2 = select_parents(survivors, survivor_fitnesses)
-                child = copy.deepcopy(breed(parent1, parent2)) #If the child shares dictionaries with a parent, don't mutate that dictionary
-                child = mutate(child, 3)
-                #print(f"child: {child}")
+            population, child_parents = next_generation(population, population_fitnesses, population_size, telemetry=telemetry,
+                                                        surrogate=surrogate, oversample=surrogate_oversample or 1,
+                                                        survival_rate=survival_rate, genes_to_mutate=genes_to_mutate)
 
-                new_population.append(child)
+            #Let the cache know the generation's over, a bounded cache just ages its entries, a plain one gets pruned to the survivors
+            with telemetry.phase("cache"):
+                shared_cache.end_generation(population)
 
-            population = new_population
+            telemetry.end_generation(cache_stats, best=best, avg=avg, similarity=diversity["similarity"], entropy=diversity["entropy"],
+                                     screened=screened, surrogate_rank_correlation=correlation, evaluations=pending)
 
-            #Prune (in place) the cache so only survivors exist
-            valid_keys = {shared_cache.key(ind) for ind in population}
-            for key in list(shared_cache.cache.keys()):
-                if key not in valid_keys:
-                    del shared_cache.cache[key]
+        #One last checkpoint at the end, so rerunning a finished job goes straight to the results
+        if checkpointer is not None and start_generation != number_of_iterations:
+            checkpointer.save(number_of_iterations, population, child_parents, shared_cache, screen_cutoff)
 
+        #Score the last batch of children while the pool's still open
+        evaluations += sum(ind.fitness is None for ind in population)
+        population_fitnesses = score_generation(pool, population, child_parents, workers, cache=lookup_cache)
+        elapsed = time.perf_counter() - start
 
-    with Pool(processes=cpu_count()) as pool:
-    #with Pool(processes=num_cpus) as pool: #for running on the cluster
-        population_fitnesses = pool.map(score_wrapper, population)
+    if checkpointer is not None:
+        checkpointer.wait()
 
 
     best_fitness = max(population_fitnesses)
     best_individual = population[population_fitnesses.index(best_fitness)]
 
     print(f"Final generation: best={best_fitness}, avg={sum(population_fitnesses)/len(population_fitnesses)}")
+    print(f"{evaluations} evaluations in {elapsed:.1f}s, {evaluations_per_hour(evaluations, elapsed):,.0f} per hour")
     score_individual_detailed(best_individual)
     return population, best_individual
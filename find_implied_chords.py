@@ -1,8 +1,47 @@
 """
 Given a base layout, construct all the implied chords, such as 1000: s + 0100: t = 1100: st
 """
+from collections import defaultdict
 from allowed_chords import before_vowel, after_vowel
 
+# Combinations only have to show up in one of them, so check a single set
+KNOWN_CLUSTERS = before_vowel | after_vowel
+
+# Where a node of a trie keeps the flag saying a cluster ends there
+END = None
+
+def build_trie(clusters):
+    """Nested {phoneme: node} dicts of the clusters, split into phonemes"""
+    root = {}
+    for cluster in clusters:
+        node = root
+        for phoneme in cluster.split():
+            node = node.setdefault(phoneme, {})
+        node[END] = True
+    return root
+
+# Onsets and codas kept in their own tries, a combination only has to be in one of them (the same as KNOWN_CLUSTERS)
+ONSET_TRIE = build_trie(before_vowel)
+CODA_TRIE = build_trie(after_vowel)
+CLUSTER_TRIES = (ONSET_TRIE, CODA_TRIE)
+
+def trie_step(nodes, phonemes):
+    """Follow the phonemes on from every node, dropping the ones that run out
+    An empty tuple means nothing in any of the tries carries on like this"""
+    stepped = []
+    for node in nodes:
+        for phoneme in phonemes:
+            node = node.get(phoneme)
+            if node is None:
+                break
+        else:
+            stepped.append(node)
+    return tuple(stepped)
+
+def trie_ends(nodes):
+    """Whether a whole cluster ends at any of the nodes"""
+    return any(END in node for node in nodes)
+
 def mask_is_subset(possible_subset, full_mask):
     """If a key is present in the subset that isn't in the full mask, return false"""
     return all(possible_subset_key == '0' or full_mask_key == '1' for possible_subset_key, full_mask_key in zip(possible_subset, full_mask))
@@ -15,7 +54,11 @@ def is_intersecting(accumulated_mask, mask):
     This prevents overlapping chords like SH+TK -> STKH"""
     return accumulated_mask.rfind('1') > mask.find('1')
 
-def find_combinations(target_mask, base_items, start_index=0, accumulated_mask=None):
+def find_combinations(target_mask, base_items, start_index=0, accumulated_mask=None, open_nodes=()):
+    """Every list of chord names that makes up target_mask, where every run of two or more chords at the end is a known cluster
+
+    open_nodes has where each of those runs started by the chords already picked has got to in the tries,
+    so a branch gets dropped as soon as one of them can't be the start of any cluster, instead of after it's been built"""
     if accumulated_mask is None:
         accumulated_mask = '0' * len(target_mask)
 
@@ -30,18 +73,26 @@ def find_combinations(target_mask, base_items, start_index=0, accumulated_mask=N
         if is_intersecting(accumulated_mask, mask):
             continue
 
+        # every run that's already open has this chord on the end of it now, and a new one starts here
+        phonemes = name.split()
+        stepped = [trie_step(nodes, phonemes) for nodes in open_nodes]
+        if not all(stepped):
+            continue
+
         #show what keys are already being pressed for that target combination
         new_accum = ''.join(str(int(a) | int(m)) for a, m in zip(accumulated_mask, mask))
         remainder = subtract_mask(target_mask, mask)
 
         if remainder == '0' * len(target_mask):
-            results.append([name])
+            # Filter to make sure only combos that are actually in the training data come up
+            if all(trie_ends(nodes) for nodes in stepped):
+                results.append([name])
         else:
-            for combo in find_combinations(remainder, base_items, i, new_accum):
-
-                # Filter to make sure only combos that are actually in the training data come up
-                if ' '.join([name] + combo) in before_vowel or ' '.join([name] + combo) in after_vowel:
-                    results.append([name] + combo)
+            started = trie_step(CLUSTER_TRIES, phonemes)
+            if not started:
+                continue
+            for combo in find_combinations(remainder, base_items, i, new_accum, stepped + [started]):
+                results.append([name] + combo)
 
     return results
 
@@ -65,13 +116,87 @@ def mask_to_chords(mask, order_len, base_chords):
     return sorted(results)
 
 
+def find_all_combinations(order_len, base_chords, previous=None, changed_masks=()):
+    """Every chord combination for every integer mask of the bank, combos[mask] is a set of chord strings
+
+    The first chord of a combination always covers the leftmost key of the mask, and whatever is left over
+    is a smaller mask that has already been worked out, so each mask only looks at the chords starting on its leftmost key
+    If previous is the result for a bank that only differs by the chords on changed_masks,
+    only the masks containing one of those need working out again, everything else is copied over
+    """
+    # bucket the chords by their leftmost key (bit_length), keeping the lowest bit so I can check for overlaps
+    # (the order within a bucket doesn't matter, unlike order_base_items, because everything ends up in a set)
+    items_by_first_key = defaultdict(list)
+    for mask_key, names in base_chords.items():
+        mask = int(mask_key, 2)
+        if mask == 0:
+            continue
+        for name in dict.fromkeys(names):
+            items_by_first_key[mask.bit_length()].append((mask, mask & -mask, name))
+
+    if previous is None:
+        combos = [()] * (1 << order_len)
+        targets = range(1, 1 << order_len)
+    else:
+        combos = list(previous)
+        targets = set()
+        full = (1 << order_len) - 1
+        for mask in changed_masks:
+            if mask == 0:
+                continue
+            # walk through every subset of the keys the chord doesn't use, each one added to the chord is a mask containing it
+            spare = full ^ mask
+            subset = spare
+            while True:
+                targets.add(mask | subset)
+                if subset == 0:
+                    break
+                subset = (subset - 1) & spare
+        targets = sorted(targets)
+
+    for target in targets:
+        found = set()
+        for mask, lowest_key, name in items_by_first_key[target.bit_length()]:
+            # If the chord to add isn't even a part of the target combination, give up early
+            if mask & target != mask:
+                continue
+
+            remainder = target ^ mask
+            if remainder == 0:
+                found.add(name)
+            # The rest has to come after this chord, no nestling between its keys
+            elif remainder < lowest_key:
+                for combo in combos[remainder]:
+                    joined = name + ' ' + combo
+                    if joined in KNOWN_CLUSTERS:
+                        found.add(joined)
+
+        combos[target] = found
+
+    return combos
+
+
+def combinations_to_table(order_len, combos, allowed_masks=None):
+    """Turn the combinations into {mask string: sorted chords}, skipping masks that map to []
+    allowed_masks is an optional set of integer masks to keep"""
+    return {
+        format(target, f"0{order_len}b"): sorted(found)
+        for target, found in enumerate(combos)
+        if found and (allowed_masks is None or target in allowed_masks)
+    }
+
+
+def build_mask_table(order_len, base_chords, allowed_masks=None):
+    """Same as running mask_to_chords on every mask from generate_masks, but in one pass using integer masks"""
+    return combinations_to_table(order_len, find_all_combinations(order_len, base_chords), allowed_masks)
+
+
 # Generate all possible binary masks for the left bank
 def generate_masks(length):
     """Generate all binary masks of a given length as strings."""
     return [format(i, f"0{length}b") for i in range(2 ** length)]
 
 
-from collections import defaultdict
 def generate_bank(chord_map):
     bank = defaultdict(list)
     for chord, mask in chord_map.items():
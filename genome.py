@@ -0,0 +1,175 @@
+"""
+A compact individual, instead of a (left, right) tuple of lists of single key {cluster: mask} dicts
+
+Every gene is an interned cluster id and an integer mask, kept in two flat arrays (the left bank's genes, then the right bank's),
+so copying one is two array copies rather than a deepcopy, pickling one for a worker is a few hundred bytes,
+and its cache key and hash only ever get worked out once
+"""
+import hashlib
+from array import array
+
+import numpy as np
+
+from default_bank import LEFT_CHORDS, RIGHT_CHORDS, LEFT_BANK_LEN, RIGHT_BANK_LEN
+from cluster_selection import INITIAL_KEYS, FINAL_KEYS
+
+
+def static_clusters():
+    """Every cluster the GA can come up with on its own, sorted so every process hands out the same ids
+    select_initial_cluster keeps the start of a cluster and select_final_cluster keeps the end, so those pieces are in here too"""
+    names = set(LEFT_CHORDS) | set(RIGHT_CHORDS)
+    for cluster in INITIAL_KEYS:
+        parts = cluster.split()
+        names.update(" ".join(parts[:length]) for length in range(1, len(parts) + 1))
+    for cluster in FINAL_KEYS:
+        parts = cluster.split()
+        names.update(" ".join(parts[-length:]) for length in range(1, len(parts) + 1))
+    return sorted(names)
+
+CLUSTER_NAMES = static_clusters()
+CLUSTER_IDS = {name: i for i, name in enumerate(CLUSTER_NAMES)}
+# anything past here was interned by this process alone, so it has to travel by name when pickled
+STATIC_CLUSTER_COUNT = len(CLUSTER_NAMES)
+
+def intern_cluster(name):
+    cluster_id = CLUSTER_IDS.get(name)
+    if cluster_id is None:
+        cluster_id = CLUSTER_IDS[name] = len(CLUSTER_NAMES)
+        CLUSTER_NAMES.append(name)
+    return cluster_id
+
+
+def key_digest(key):
+    """64 bit hash of a FitnessCache key (never 0, the shared cache uses that for empty slots)"""
+    digest = hashlib.blake2b(repr(key).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little") or 1
+
+
+class Genome:
+    __slots__ = ("clusters", "masks", "split", "fitness", "_key", "_digest")
+
+    BANK_LENS = (LEFT_BANK_LEN, RIGHT_BANK_LEN)
+
+    def __init__(self, clusters, masks, split, fitness=None):
+        self.clusters = clusters # array('I') of interned cluster ids
+        self.masks = masks # array('H') of integer masks, the leftmost key is the highest bit
+        self.split = split # genes before this are in the left bank
+        self.fitness = fitness
+        self._key = None
+        self._digest = None
+
+    @classmethod
+    def from_individual(cls, individual):
+        """From the (left, right) lists of {cluster: mask} genes"""
+        left, right = individual
+        clusters = array('I')
+        masks = array('H')
+        for part in (left, right):
+            for gene in part:
+                cluster, mask = next(iter(gene.items()))
+                clusters.append(intern_cluster(cluster))
+                masks.append(int(mask, 2))
+        return cls(clusters, masks, len(left))
+
+    @classmethod
+    def from_rows(cls, clusters, masks, split):
+        """From numpy rows of cluster ids and integer masks"""
+        return cls(array('I', clusters.astype(np.uint32).tobytes()), array('H', masks.astype(np.uint16).tobytes()), split)
+
+    def to_individual(self):
+        """Back to the (left, right) lists of {cluster: mask} genes"""
+        return tuple(
+            [{CLUSTER_NAMES[self.clusters[i]]: format(self.masks[i], f"0{self.BANK_LENS[half]}b")} for i in self.half_range(half)]
+            for half in (0, 1)
+        )
+
+    # Reads like the old tuple, so left, right = genome and genome[0] still work (as copies, changing them does nothing)
+    def __iter__(self):
+        return iter(self.to_individual())
+
+    def __getitem__(self, half):
+        return self.to_individual()[half]
+
+    def __repr__(self):
+        return f"Genome{self.to_individual()}"
+
+    def half_range(self, half):
+        return range(0, self.split) if half == 0 else range(self.split, len(self.clusters))
+
+    def bank_len(self, half):
+        return self.BANK_LENS[half]
+
+    def bank_chords(self):
+        """(left, right) banks as {mask: [clusters]}, same as bank_genes_into_bank_chords on each half"""
+        banks = ({}, {})
+        for half in (0, 1):
+            width = self.BANK_LENS[half]
+            for i in self.half_range(half):
+                banks[half].setdefault(format(self.masks[i], f"0{width}b"), []).append(CLUSTER_NAMES[self.clusters[i]])
+        return banks
+
+    def copy(self):
+        return Genome(array('I', self.clusters), array('H', self.masks), self.split, self.fitness)
+
+    def set_gene(self, index, cluster_id, mask):
+        self.clusters[index] = cluster_id
+        self.masks[index] = mask
+        # it's a different layout now
+        self.fitness = None
+        self._key = None
+        self._digest = None
+
+    def shared_genes(self, other):
+        """How many genes are the same, in the same place, as in other"""
+        return sum(
+            1 for c1, m1, c2, m2 in zip(self.clusters, self.masks, other.clusters, other.masks)
+            if c1 == c2 and m1 == m2
+        )
+
+    def gene_set(self):
+        """Every (bank, cluster, mask) the genome has, ignoring order and duplicates"""
+        return {(i >= self.split, self.clusters[i], self.masks[i]) for i in range(len(self.clusters))}
+
+    def key(self):
+        """Exactly what FitnessCache.key gives for the same individual as a tuple, so both kinds share cache entries"""
+        if self._key is None:
+            self._key = tuple(
+                tuple(sorted(
+                    (CLUSTER_NAMES[self.clusters[i]], format(self.masks[i], f"0{self.BANK_LENS[half]}b"))
+                    for i in self.half_range(half)
+                ))
+                for half in (0, 1)
+            )
+        return self._key
+
+    def digest(self):
+        if self._digest is None:
+            self._digest = key_digest(self.key())
+        return self._digest
+
+    def __eq__(self, other):
+        return isinstance(other, Genome) and self.key() == other.key()
+
+    def __hash__(self):
+        return self.digest()
+
+    def __getstate__(self):
+        extra_names = {cluster_id: CLUSTER_NAMES[cluster_id] for cluster_id in set(self.clusters) if cluster_id >= STATIC_CLUSTER_COUNT}
+        return (self.clusters.tobytes(), self.masks.tobytes(), self.split, self.fitness, extra_names)
+
+    def __setstate__(self, state):
+        cluster_bytes, mask_bytes, self.split, self.fitness, extra_names = state
+        self.clusters = array('I')
+        self.clusters.frombytes(cluster_bytes)
+        self.masks = array('H')
+        self.masks.frombytes(mask_bytes)
+        # clusters only the sending process knew about might have different ids here
+        if extra_names:
+            remap = {cluster_id: intern_cluster(name) for cluster_id, name in extra_names.items()}
+            self.clusters = array('I', (remap.get(c, c) for c in self.clusters))
+        self._key = None
+        self._digest = None
+
+
+def as_genome(individual):
+    return individual if isinstance(individual, Genome) else Genome.from_individual(individual)
@@ -0,0 +1,166 @@
+"""
+Scoring a child by starting from its parent's match state, so only the parts touched by the genes that changed get redone
+
+A child is a crossover and a few mutations away from a parent that's already been scored,
+so rather than rebuilding both banks and matching the whole corpus again, I keep what the parent matched
+and only redo the masks that contain a changed chord, and the pronunciations whose clusters those masks gained or lost
+"""
+from collections import OrderedDict
+import numpy as np
+
+from layout_fitness_measurer import (
+    LEFT_TABLE_CACHE, RIGHT_TABLE_CACHE, CORPUS_ARRAYS,
+    individual_banks, layout_scores, fitness_from_scores, score_individual
+)
+
+
+def bank_items(bank):
+    """The distinct (integer mask, cluster) pairs of a bank, which is all its combinations depend on"""
+    return {(int(mask, 2), cluster) for mask, clusters in bank.items() for cluster in clusters}
+
+
+class BankState:
+    """One bank's chords along with the combinations, mask table and cluster pairs they produce"""
+
+    def __init__(self, base_chords, table_cache, cluster_ids, parent=None):
+        self.table_cache = table_cache
+        self.cluster_ids = cluster_ids
+        self.items = bank_items(base_chords)
+
+        # clusters that a usable mask gained or lost compared to the parent
+        self.changed_clusters = set()
+        if parent is None:
+            self.combos, self.table = table_cache.compile(base_chords)
+        else:
+            changed_masks = {mask for mask, _ in self.items ^ parent.items}
+            self.combos, self.table = table_cache.compile(base_chords, parent.combos, changed_masks)
+            allowed_masks = table_cache.allowed_masks
+            for target, (old, new) in enumerate(zip(parent.combos, self.combos)):
+                if old is not new and (allowed_masks is None or target in allowed_masks):
+                    self.changed_clusters.update(set(old) ^ new)
+
+        self.pairs = CORPUS_ARRAYS.cluster_pairs(self.table, cluster_ids)
+
+    def updated(self, base_chords):
+        """The bank for base_chords, worked out from this one, along with the clusters that changed"""
+        if bank_items(base_chords) == self.items:
+            return self, set()
+        bank = BankState(base_chords, self.table_cache, self.cluster_ids, parent=self)
+        return bank, bank.changed_clusters
+
+
+# Multi-fidelity screening: a child's coverage is exact and cheap (pair_coverage), but conflict needs the full join,
+# so first it's only matched against the SCREEN_TOP_K pronunciations with the most likely words.
+# That conflict can only go up once the rest are added, so the fitness it gives is an upper bound,
+# and a child whose bound can't reach the survivor cutoff doesn't get the full join at all
+SCREEN_TOP_K = 5000
+SCREEN_MARGIN = 1e-9 # the bound and the real fitness add things up in different orders
+screen_corpora = {}
+
+def screen_corpus(top_k, corpus=CORPUS_ARRAYS):
+    """corpus.top_pronunciations(top_k), built once per worker"""
+    if top_k not in screen_corpora:
+        screen_corpora[top_k] = corpus.top_pronunciations(top_k)
+    return screen_corpora[top_k]
+
+
+def fitness_upper_bound(left_pairs, right_pairs, screen, corpus=CORPUS_ARRAYS):
+    """The most the full fitness can be: the exact coverage, with the conflict from the screening corpus
+    (fitness_from_scores only goes down as the conflict goes up, for the same coverage)"""
+    coverage = corpus.pair_coverage(left_pairs, right_pairs)
+    _, conflict = screen.score_rows(*screen.match_pairs(left_pairs, right_pairs))
+    return fitness_from_scores(layout_scores(coverage, conflict))
+
+
+class LayoutState:
+    """Everything an individual matched, enough to score it and to start its children from"""
+
+    def __init__(self, individual, parent=None, corpus=CORPUS_ARRAYS, screen=None, cutoff=None):
+        """With a screen corpus and a cutoff, an individual whose fitness_upper_bound is below the cutoff stops there,
+        with just its bound worked out (and rows, scores and fitness left as None)"""
+        left_bank, right_bank = individual_banks(individual)
+
+        if parent is None:
+            self.left = BankState(left_bank, LEFT_TABLE_CACHE, corpus.left_ids)
+            self.right = BankState(right_bank, RIGHT_TABLE_CACHE, corpus.right_ids)
+        else:
+            self.left, left_changed = parent.left.updated(left_bank)
+            self.right, right_changed = parent.right.updated(right_bank)
+
+        self.bound = None
+        if screen is not None:
+            self.bound = fitness_upper_bound(self.left.pairs, self.right.pairs, screen, corpus)
+            if self.bound + SCREEN_MARGIN < cutoff:
+                self.rows = self.scores = self.fitness = None
+                return
+
+        if parent is None:
+            self.rows = corpus.match_pairs(self.left.pairs, self.right.pairs)
+        else:
+            # Throw away the parent's rows for any split involving a changed cluster, and match just those splits again
+            touched = corpus.splits_touching(left_changed, right_changed)
+            if len(touched) == 0:
+                self.rows = parent.rows
+            else:
+                redo = np.zeros(len(corpus.split_left), dtype=bool)
+                redo[touched] = True
+                kept = ~redo[parent.rows[0]]
+                redone = corpus.match_pairs(self.left.pairs, self.right.pairs, touched)
+                self.rows = tuple(np.concatenate((old[kept], new)) for old, new in zip(parent.rows, redone))
+
+        self.scores = layout_scores(*corpus.score_rows(*self.rows))
+        self.fitness = fitness_from_scores(self.scores)
+
+
+# Each worker hangs on to the states it has built recently, so a parent that comes round again doesn't need rebuilding
+STATE_CACHE_SIZE = 64
+state_cache = OrderedDict()
+
+def remember_state(key, state):
+    state_cache[key] = state
+    state_cache.move_to_end(key)
+    while len(state_cache) > STATE_CACHE_SIZE:
+        state_cache.popitem(last=False)
+
+
+def score_family(parent, children, cache, cutoff=None, top_k=SCREEN_TOP_K, looked_up=False):
+    """Score every child bred from parent, starting each one from the parent's state rather than from scratch
+    With a cutoff, children are screened first (see LayoutState) and each one comes back as (fitness, exact),
+    a child that didn't make it gets its upper bound with exact False, and it isn't cached
+    looked_up means the caller has already checked the cache for the children, so it isn't asked again"""
+    if cache is None:
+        from evolve_population import worker_cache
+        cache = worker_cache
+
+    try:
+        parent_key = cache.key(parent)
+        parent_state = state_cache.get(parent_key)
+        if parent_state is None:
+            parent_state = LayoutState(parent)
+        remember_state(parent_key, parent_state)
+
+        screen = screen_corpus(top_k) if cutoff is not None else None
+        fitnesses = []
+        for child in children:
+            cached_value = None if looked_up else cache.get(child)
+            exact = True
+            if cached_value is None:
+                state = LayoutState(child, parent_state, screen=screen, cutoff=cutoff)
+                if state.fitness is None:
+                    cached_value, exact = state.bound, False
+                else:
+                    cached_value = state.fitness
+                    cache.set(child, cached_value)
+                    remember_state(cache.key(child), state)
+            fitnesses.append(cached_value if cutoff is None else (cached_value, exact))
+        return fitnesses
+
+    except Exception as e:
+        print("Error scoring family:", e)
+        fitnesses = [score_individual(child, cache) for child in children]
+        return fitnesses if cutoff is None else [(fitness, True) for fitness in fitnesses]
+
+
+def score_families(families, cache, cutoff=None, top_k=SCREEN_TOP_K, looked_up=False):
+    """score_family for a chunk of (parent, children) families, so a worker gets a batch of them per task"""
+    return [score_family(parent, children, cache, cutoff, top_k, looked_up) for parent, children in families]
@@ -0,0 +1,158 @@
+"""
+Island mode: rather than one population scored by a Pool with everyone waiting on the slowest individual every generation,
+each process evolves its own smaller population (with the same select_survivors/breed/mutate as evolve_population)
+and every so often the islands send copies of their best individuals to each other
+
+Nothing waits on anything else, migrants just get picked up by whichever generation an island's on when they arrive,
+so it scales with cores, and the islands drifting apart keeps the overall population a lot more diverse than one big one
+"""
+import random
+from multiprocessing import Process, Queue, cpu_count
+from queue import Empty
+
+from tqdm import tqdm
+
+from genome import as_genome
+from evolve_population import next_generation, score_generation, init_worker
+from diversity import population_diversity
+from layout_fitness_measurer import score_individual_detailed
+from shared_fitness_cache import SharedFitnessCache
+
+TOPOLOGIES = ("ring", "random")
+
+
+class InlinePool:
+    """Stands in for a Pool on an island, which scores its own individuals itself"""
+    def starmap(self, func, iterable):
+        return [func(*args) for args in iterable]
+
+
+def migration_targets(island, island_count, topology, rng):
+    """Which islands this one sends its migrants to"""
+    if island_count < 2:
+        return []
+    if topology == "ring":
+        return [(island + 1) % island_count]
+    if topology == "random":
+        return [rng.choice([other for other in range(island_count) if other != island])]
+    raise ValueError(f"Unknown topology {topology!r}, expected one of {TOPOLOGIES}")
+
+
+def take_migrants(inbox):
+    """Everything that's arrived so far, without waiting for anything"""
+    migrants = []
+    while True:
+        try:
+            migrants.extend(inbox.get_nowait())
+        except Empty:
+            return migrants
+
+
+def run_island(island, population, number_of_iterations, shared_cache, inboxes, results, seed,
+               migration_interval, migrants, topology, report_interval):
+    init_worker(shared_cache)
+    # the island's own stream of random numbers, the GA operators all use the random module
+    random.seed(seed)
+    rng = random.Random(seed + 1)
+    # migrants to an island that's already finished aren't worth waiting around to deliver
+    for inbox in inboxes:
+        inbox.cancel_join_thread()
+
+    pool = InlinePool()
+    population_size = len(population)
+    child_parents = {}
+    for generation in range(number_of_iterations):
+        population_fitnesses = score_generation(pool, population, child_parents, 1, cache=shared_cache)
+
+        if migration_interval and generation % migration_interval == 0 and generation > 0:
+            # send copies of the best few on
+            ranked = sorted(range(population_size), key=lambda i: population_fitnesses[i], reverse=True)
+            emigrants = [population[i].copy() for i in ranked[:migrants]]
+            for target in migration_targets(island, len(inboxes), topology, rng):
+                inboxes[target].put(emigrants)
+
+            # and anyone who's arrived here takes the place of the worst
+            arrived = take_migrants(inboxes[island])
+            for i, migrant in zip(reversed(ranked), arrived[:population_size // 2]):
+                population[i] = migrant
+                population_fitnesses[i] = migrant.fitness
+
+        if report_interval and generation % report_interval == 0:
+            results.put(("progress", island, generation, max(population_fitnesses), sum(population_fitnesses) / population_size))
+        else:
+            results.put(("progress", island, generation, None, None))
+
+        population, child_parents = next_generation(population, population_fitnesses, population_size)
+
+        # The shared cache only has the one clock, so island 0 keeps it ticking over for everyone
+        # (a plain FitnessCache doesn't get pruned in island mode, pruning it to one island's population would empty it for the rest)
+        if island == 0 and isinstance(shared_cache, SharedFitnessCache):
+            shared_cache.end_generation(population)
+
+    # score the last children before sending the island back
+    score_generation(pool, population, child_parents, 1, cache=shared_cache)
+    results.put(("done", island, population))
+
+
+def evolve_islands(population, number_of_iterations, shared_cache, islands=None, migration_interval=10, migrants=2,
+                   topology="ring", report_interval=10):
+    """Same as evolve_population, but split into islands (one process each, a core per island by default)
+    Every migration_interval generations each island sends copies of its best `migrants` to the next island round the ring,
+    or to a random other island, and whatever's arrived replaces its worst
+    Returns the final population of every island put back together, and the best individual"""
+    if topology not in TOPOLOGIES:
+        raise ValueError(f"Unknown topology {topology!r}, expected one of {TOPOLOGIES}")
+    population = [as_genome(ind) for ind in population]
+    if islands is None:
+        islands = cpu_count()
+    islands = max(1, min(islands, len(population) // 4)) # an island needs a few individuals to breed
+
+    # deal the population out, and give each island its own seed drawn from the main random state
+    subpopulations = [population[i::islands] for i in range(islands)]
+    seeds = [random.randrange(2**32) for _ in range(islands)]
+
+    inboxes = [Queue() for _ in range(islands)]
+    results = Queue()
+    processes = [
+        Process(target=run_island, args=(island, subpopulations[island], number_of_iterations, shared_cache, inboxes, results,
+                                         seeds[island], migration_interval, migrants, topology, report_interval))
+        for island in range(islands)
+    ]
+    for process in processes:
+        process.start()
+
+    final_populations = [None] * islands
+    try:
+        with tqdm(total=islands * number_of_iterations, desc="Evolving islands", unit="gen") as progress:
+            while any(p is None for p in final_populations):
+                try:
+                    message = results.get(timeout=5)
+                except Empty:
+                    # an island that died without sending its population back is never going to
+                    dead = [island for island, process in enumerate(processes)
+                            if final_populations[island] is None and not process.is_alive()]
+                    if dead:
+                        raise RuntimeError(f"Island(s) {dead} exited without finishing")
+                    continue
+                if message[0] == "done":
+                    final_populations[message[1]] = message[2]
+                    continue
+                _, island, generation, best, avg = message
+                progress.update(1)
+                if best is not None:
+                    tqdm.write(f"Island {island} generation {generation}: best={best}, avg={avg}")
+    finally:
+        for process in processes:
+            process.join(timeout=None if all(p is not None for p in final_populations) else 0)
+            if process.is_alive():
+                process.terminate()
+
+    population = [ind for island_population in final_populations for ind in island_population]
+    population_fitnesses = [ind.fitness for ind in population]
+    best_fitness = max(population_fitnesses)
+    best_individual = population[population_fitnesses.index(best_fitness)]
+
+    diversity = population_diversity(population)
+    print(f"Final generation: best={best_fitness}, avg={sum(population_fitnesses)/len(population_fitnesses)}, similarity={diversity['similarity']:.4f}, entropy={diversity['entropy']:.3f}")
+    score_individual_detailed(best_individual)
+    return population, best_individual
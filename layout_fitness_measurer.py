@@ -2,9 +2,13 @@ import json
 import re
 import time
 import math
+import hashlib
 from default_bank import LEFT_CHORDS, RIGHT_CHORDS, LEFT_BANK_LEN, RIGHT_BANK_LEN
-from find_implied_chords import generate_masks, mask_to_chords
-from collections import defaultdict
+from find_implied_chords import generate_masks, find_all_combinations, combinations_to_table
+from vectorised_scoring import CorpusArrays
+from corpus_artifact import load_corpus
+from genome import Genome
+from collections import defaultdict, OrderedDict
 
 class FitnessCache:
     def __init__(self, shared_dict=None):
@@ -12,6 +16,9 @@ class FitnessCache:
         self.cache = shared_dict if shared_dict is not None else {}
 
     def key(self, individual):
+        if isinstance(individual, Genome):
+            return individual.key() # worked out once and kept on the genome
+
         left, right = individual
 
         def freeze(part):
@@ -26,22 +33,44 @@ class FitnessCache:
     def get(self, individual):
         return self.cache.get(self.key(individual))
 
+    def get_many(self, individuals):
+        """get for a whole batch, None for anything that isn't in here"""
+        return [self.get(individual) for individual in individuals]
+
     def set(self, individual, value):
         self.cache[self.key(individual)] = value
 
+    def prune(self, population):
+        """Only keep the fitnesses of the given individuals"""
+        valid_keys = {self.key(ind) for ind in population}
+        for key in list(self.cache.keys()):
+            if key not in valid_keys:
+                del self.cache[key]
+
+    def generation_stats(self):
+        return {"entries": len(self.cache)}
+
+    def end_generation(self, population):
+        # There's no limit on a plain dict, so it has to be pruned down to the current population every generation
+        self.prune(population)
+
 #cacheing lodgic
 #removed because instead of a global variable, I'm now passing it in
 #fitness_cache = None #I will initialise this in the main process once with FitnessCache(shared_dict=_shared_cache)
 
 
 PRON_FREQ_FILE = "pronunciation_frequency.json"
-with open(PRON_FREQ_FILE, "r", encoding="utf-8") as f:
-    PRONUNCIATIONS = json.load(f)
 
 # Instead of evolving the vowel bank, I'm treating that as a solved problem, 4 keys to categorise 16 vowels with space for homophone resolution too, reed/read/red
 VOWELS = {"AA", "AE", "AH", "AO", "AW", "AY",
           "EH", "ER", "EY", "IH", "IY", "OW", "OY", "UH", "UW"}
 
+# The compiled corpus if there's an up to date one, otherwise everything below gets built from the JSON
+CORPUS = load_corpus(PRON_FREQ_FILE, VOWELS)
+if CORPUS is None:
+    with open(PRON_FREQ_FILE, "r", encoding="utf-8") as f:
+        PRONUNCIATIONS = json.load(f)
+
 # The genes are chords, I would like to generate the corresponding layout
 def generate_bank(chord_map):
     bank = defaultdict(list)
@@ -53,35 +82,81 @@ def generate_bank(chord_map):
 LEFT_BANK = generate_bank(LEFT_CHORDS)
 RIGHT_BANK = generate_bank(RIGHT_CHORDS)
 
-# Build left bank masks
-LEFT_BANK_MASKS = {
-    mask: mask_to_chords(mask, LEFT_BANK_LEN, LEFT_BANK)
-    for mask in generate_masks(LEFT_BANK_LEN)
-    # skip if maps to []
-    if (chords := mask_to_chords(mask, LEFT_BANK_LEN, LEFT_BANK))
-}
-
-# Build right bank masks with some disallowed endings
+# Some key combinations on the right require contorting the hand, so I'll disallow those
+# Working out which ones once, rather than running the regex for every mask of every individual
 DISALLOWED_ENDINGS = r'(1..1|11.)$'
-RIGHT_BANK_MASKS = {
-    mask: mask_to_chords(mask, RIGHT_BANK_LEN, RIGHT_BANK)
+RIGHT_ALLOWED_MASKS = frozenset(
+    int(mask, 2)
     for mask in generate_masks(RIGHT_BANK_LEN)
-    # however, some key combinations require contorting the hand, so I'll disallow those
     if re.search(DISALLOWED_ENDINGS, mask) is None
-    # skip if maps to []
-    and (chords := mask_to_chords(mask, RIGHT_BANK_LEN, RIGHT_BANK)) 
-}
+)
+
+class MaskTableCache:
+    """The compiled combinations and mask table of one bank, for the most recently seen versions of that bank
+
+    Crossover often leaves a whole half of a child the same as one of its parents, and the right bank alone is 1024 masks to work out,
+    so each worker keeps the tables it has built, keyed by a digest of that half of the genome
+    """
+    def __init__(self, order_len, allowed_masks=None, capacity=128):
+        self.order_len = order_len
+        self.allowed_masks = allowed_masks
+        self.capacity = capacity
+        self.tables = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def digest(self, bank):
+        """Same digest however the genes are ordered or duplicated, since neither changes the table"""
+        items = sorted({(mask, cluster) for mask, clusters in bank.items() for cluster in clusters})
+        return hashlib.blake2b(repr(items).encode(), digest_size=16).digest()
+
+    def compile(self, bank, previous=None, changed_masks=()):
+        """(combos, table) for the bank chords, previous and changed_masks get passed on to find_all_combinations on a miss"""
+        key = self.digest(bank)
+        compiled = self.tables.get(key)
+        if compiled is not None:
+            self.hits += 1
+            self.tables.move_to_end(key)
+            return compiled
+
+        self.misses += 1
+        combos = find_all_combinations(self.order_len, bank, previous, changed_masks)
+        compiled = (combos, combinations_to_table(self.order_len, combos, self.allowed_masks))
+        self.tables[key] = compiled
+        if len(self.tables) > self.capacity:
+            self.tables.popitem(last=False)
+        return compiled
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self.tables),
+        }
 
+# One of each per process, so every worker builds up its own
+LEFT_TABLE_CACHE = MaskTableCache(LEFT_BANK_LEN)
+RIGHT_TABLE_CACHE = MaskTableCache(RIGHT_BANK_LEN, RIGHT_ALLOWED_MASKS)
 
-def find_vowel_split_matches(pronunciations, vowels, left_masks, right_masks):
-    matches = {}
+def build_bank_masks(left_bank, right_bank):
+    """Every mask (that does something) for each bank, mapped to the chords it produces"""
+    _, left_masks = LEFT_TABLE_CACHE.compile(left_bank)
+    _, right_masks = RIGHT_TABLE_CACHE.compile(right_bank)
+    return left_masks, right_masks
 
-    # find the blank masks
-    blank_left = "0" * len(next(iter(left_masks)))
-    blank_right = "0" * len(next(iter(right_masks)))
+# Build the masks for the default layout, skipping the ones that map to []
+LEFT_BANK_MASKS, RIGHT_BANK_MASKS = build_bank_masks(LEFT_BANK, RIGHT_BANK)
 
-    for pron, data in pronunciations.items():
+
+def build_vowel_splits(pronunciations, vowels):
+    """Split every pronunciation at every vowel, (left cluster, vowel, right cluster, pronunciation, weight)
+    The splits never change between individuals, so this only has to happen once"""
+    splits = []
+    for pron, word_freqs in pronunciations.items():
         phonemes = pron.split()
+        weight = sum(zipf_to_prob(z) for z in word_freqs.values())
 
         # Find all vowels in the pronunciation
         for i, ph in enumerate(phonemes):
@@ -90,36 +165,50 @@ def find_vowel_split_matches(pronunciations, vowels, left_masks, right_masks):
 
             left_part = " ".join(phonemes[:i])
             right_part = " ".join(phonemes[i + 1:])
+            splits.append((left_part, ph, right_part, pron, weight))
+
+    return splits
+
 
-            # left masks
-            if left_part == "":
-                possible_left = [blank_left]  # must be blank if starts with vowel
-            else:
-                possible_left = [
-                    lm for lm, chords in left_masks.items()
-                    if left_part in chords
-                ]
-
-            # right masks
-            if right_part == "":
-                possible_right = [blank_right]
-            else:
-                possible_right = [
-                    rm for rm, chords in right_masks.items()
-                    if right_part in chords
-                ]
-
-            # Record all valid mask combos for this pronunciation
-            for lm in possible_left:
-                for rm in possible_right:
-                    combo = f"{lm}-{ph}-{rm}"
-                    matches.setdefault(combo, []).append(pron)
+def masks_by_cluster(masks):
+    """Flip {mask: [clusters]} around into {cluster: [masks]}, keeping the masks in order
+    An empty cluster can only be typed with the blank mask"""
+    lookup = {"": ["0" * len(next(iter(masks)))]}
+    for mask, chords in masks.items():
+        for chord in chords:
+            lookup.setdefault(chord, []).append(mask)
+    return lookup
+
+
+def match_vowel_splits(splits, left_masks, right_masks):
+    matches = {}
+
+    left_lookup = masks_by_cluster(left_masks)
+    right_lookup = masks_by_cluster(right_masks)
+
+    for left_part, ph, right_part, pron, _ in splits:
+        possible_left = left_lookup.get(left_part)
+        if possible_left is None:
+            continue
+        possible_right = right_lookup.get(right_part)
+        if possible_right is None:
+            continue
+
+        # Record all valid mask combos for this pronunciation
+        for lm in possible_left:
+            for rm in possible_right:
+                combo = f"{lm}-{ph}-{rm}"
+                matches.setdefault(combo, []).append(pron)
 
     # Now check for ambiguity (same combo matches multiple pronunciations)
     ambiguous = {combo: ps for combo, ps in matches.items() if len(ps) > 1}
     return matches, ambiguous
 
 
+def find_vowel_split_matches(pronunciations, vowels, left_masks, right_masks):
+    return match_vowel_splits(build_vowel_splits(pronunciations, vowels), left_masks, right_masks)
+
+
 def zipf_to_prob(zipf):
     """Convert Zipf frequency to relative probability."""
     return 10 ** (zipf - 6)
@@ -160,6 +249,10 @@ def score_layout(matches, ambiguous, pron_freqs):
             if p < max_prob:
                 conflict_score += p
 
+    return layout_scores(coverage_score, conflict_score)
+
+
+def layout_scores(coverage_score, conflict_score):
     def prob_to_zipf(p):
         return 6 + math.log10(p) if p > 0 else 0
 
@@ -171,6 +264,38 @@ def score_layout(matches, ambiguous, pron_freqs):
         "conflict_ratio": conflict_score / coverage_score if coverage_score > 0 else 0
     }
 
+
+def score_layout_arrays(left_masks, right_masks, corpus=None):
+    """Same output as score_layout(*match_vowel_splits(...)), but done on the numpy arrays"""
+    if corpus is None:
+        corpus = CORPUS_ARRAYS
+    return layout_scores(*corpus.score(left_masks, right_masks))
+
+# Every pronunciation split at every vowel, built once at load time
+# And the same again as integer arrays for the numpy scoring, mapped straight from the compiled corpus when there is one
+if CORPUS is not None:
+    CORPUS_ARRAYS = CORPUS.corpus_arrays()
+else:
+    VOWEL_SPLITS = build_vowel_splits(PRONUNCIATIONS, VOWELS)
+    CORPUS_ARRAYS = CorpusArrays.from_splits(VOWEL_SPLITS, PRONUNCIATIONS, zipf_to_prob)
+
+
+def corpus_dicts():
+    """(PRONUNCIATIONS, VOWEL_SPLITS)
+    With the compiled corpus these only get built the first time they're asked for, the GA itself only needs CORPUS_ARRAYS"""
+    if CORPUS is not None:
+        return CORPUS.pronunciations(), CORPUS.vowel_splits()
+    return PRONUNCIATIONS, VOWEL_SPLITS
+
+
+def __getattr__(name):
+    # so layout_fitness_measurer.PRONUNCIATIONS still works from outside when it hasn't been built
+    if name == "PRONUNCIATIONS":
+        return corpus_dicts()[0]
+    if name == "VOWEL_SPLITS":
+        return corpus_dicts()[1]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 def bank_genes_into_bank_chords(chord_list):
     chords = {}
     for d in chord_list:
@@ -178,85 +303,99 @@ def bank_genes_into_bank_chords(chord_list):
             chords.setdefault(mask, []).append(cluster)
     return chords
 
-def score_individual(individual, cache):
-    # If this individual's already been scored, it should be in the cache
-    if cache is None:
-        from evolve_population import worker_cache
-        cache = worker_cache
+def individual_banks(individual):
+    """The (left, right) bank chords of an individual, whether it's a Genome or a tuple of gene lists"""
+    if isinstance(individual, Genome):
+        return individual.bank_chords()
+    left_bank_genes, right_bank_genes = individual
+    return bank_genes_into_bank_chords(left_bank_genes), bank_genes_into_bank_chords(right_bank_genes)
+
+# What fitness_from_scores works with, set_fitness_params changes them for this process (a sweep runs each setting in its own)
+FITNESS_PARAMS = {
+    #initial target, not penalising conflicts too much
+    "alpha": 10.0,
+    "beta": 1.0,
+    #target, once it gets to here, conflicts will be at 0.0015
+    "coverage_threshold": 522, #  WSI is at 522.67
+    "target_conflict": 0.0012, # WSI is at 001237
+    #how steeply the conflict penalty comes in, and where it's halfway there
+    "a": 0.15,
+    "midpoint": 486, #not 486 because I'm scared of it converging too quickly, okay maybe
+    # penalty strength
+    "s": 50, # adjust as needed
+}
+DEFAULT_FITNESS_PARAMS = dict(FITNESS_PARAMS)
 
-    cached_value = cache.get(individual)
-    if cached_value is not None:
-        return cached_value
 
+def set_fitness_params(**params):
+    """Change what this process scores with, anything not given stays as it is
+    Fitnesses from different settings aren't comparable, so they mustn't end up in the same FitnessCache"""
+    unknown = set(params) - set(FITNESS_PARAMS)
+    if unknown:
+        raise ValueError(f"Unknown fitness parameter(s) {sorted(unknown)}, expected some of {list(FITNESS_PARAMS)}")
+    FITNESS_PARAMS.update(params)
 
-    try:
-        left_bank_genes, right_bank_genes = individual
 
-        left_bank=bank_genes_into_bank_chords(left_bank_genes)
-        right_bank=bank_genes_into_bank_chords(right_bank_genes)
+def fitness_from_scores(scores, params=None):
+    """Squash the layout scores down to the single number the GA is maximising
+    params is a FITNESS_PARAMS style dict to use instead of this process's"""
+    if params is None:
+        params = FITNESS_PARAMS
+    coverage = scores["coverage_prob"]
+    conflict = scores["conflict_ratio"]
 
-        left_masks = {
-            mask: mask_to_chords(mask, LEFT_BANK_LEN, left_bank)
-            for mask in generate_masks(LEFT_BANK_LEN)
-            if (mask_to_chords(mask, LEFT_BANK_LEN, left_bank))
-        }
+    alpha = params["alpha"]
+    beta = params["beta"]
+    coverage_threshold = params["coverage_threshold"]
+    target_conflict = params["target_conflict"]
 
-        right_masks = {
-            mask: mask_to_chords(mask, RIGHT_BANK_LEN, right_bank)
-            for mask in generate_masks(RIGHT_BANK_LEN)
-            if (mask_to_chords(mask, RIGHT_BANK_LEN, right_bank))
-            and re.search(DISALLOWED_ENDINGS, mask) is None
-        }
+    #I'm basically saying to move past 522 coverage, you gotta have lower conflict ratio than WSI
+
+    if coverage > (coverage_threshold+5) and conflict < target_conflict:
+        return math.log10(coverage**alpha * (1 - conflict)**beta)
+
+    #I want this effect to come in gradually, so I'm using a sigmoid function starting at 450 (takes about 20 generations to reach this coverage) and then ends at 522(coverage of the WSI layout)
+    a = params["a"]
+    midpoint = params["midpoint"]
+    activation = 1 / (1 + math.exp(-a * (coverage - midpoint)))
 
-        matches, ambiguous = find_vowel_split_matches(
-            PRONUNCIATIONS,
-            VOWELS,
-            left_masks,
-            right_masks
-        )
+    excess_conflict = max(0.0, conflict - target_conflict)
 
+    penalty = 1 + params["s"] * activation * excess_conflict
 
-        scores = score_layout(matches, ambiguous, PRONUNCIATIONS)
+    return math.log10(coverage**alpha * (1 - conflict)**beta / penalty)
 
-        coverage = scores["coverage_prob"]
-        conflict = scores["conflict_ratio"]
+def score_individual(individual, cache):
+    # If this individual's already been scored, it should be in the cache
+    if cache is None:
+        from evolve_population import worker_cache
+        cache = worker_cache
 
-        #initial target, not penalising conflicts too much
-        alpha = 10.0
-        beta = 1.0
+    # A genome that's already been scored carries its fitness around with it
+    if isinstance(individual, Genome) and individual.fitness is not None:
+        return individual.fitness
 
-        #target, once it gets to here, conflicts will be at 0.0015
-        coverage_threshold = 522 #  WSI is at 522.67
-        target_conflict = 0.0012 # WSI is at 001237
+    cached_value = cache.get(individual)
+    if cached_value is not None:
+        return cached_value
 
-        #I'm basically saying to move past 522 coverage, you gotta have lower conflict ratio than WSI
 
-        if coverage > (coverage_threshold+5) and conflict < target_conflict:
-            overall_fitness = math.log10(coverage**alpha * (1 - conflict)**beta)
-            # Cache it
-            cache.set(individual, overall_fitness)
-            return overall_fitness
+    try:
+        left_bank, right_bank = individual_banks(individual)
 
-        #I want this effect to come in gradually, so I'm using a sigmoid function starting at 450 (takes about 20 generations to reach this coverage) and then ends at 522(coverage of the WSI layout)
-        a = 0.15
-        midpoint = 486 #not 486 because I'm scared of it converging too quickly, okay maybe
-        activation = 1 / (1 + math.exp(-a * (coverage - midpoint)))
+        left_masks, right_masks = build_bank_masks(left_bank, right_bank)
 
-        excess_conflict = max(0.0, conflict - target_conflict)
+        scores = score_layout_arrays(left_masks, right_masks)
 
-        # penalty strength
-        s = 50  # adjust as needed
-        penalty = 1 + s * activation * excess_conflict
+        overall_fitness = fitness_from_scores(scores)
 
-        overall_fitness = math.log10(coverage**alpha * (1 - conflict)**beta / penalty)
-        
         # Cache it
         cache.set(individual, overall_fitness)
         return overall_fitness
 
     except Exception as e:
         print("Error scoring individual:", e)
-        return 1 
+        return 1
 
     # or alternative:
     # overall_fitness = scores["coverage_zipf"] - scores["conflict_zipf"]
@@ -268,35 +407,68 @@ def score_individual(individual, cache):
     #print(f"Overall fitness: {overall_fitness:,.4f}")
 
 
+def score_population(genomes, cache=None, corpus=None, looked_up=False):
+    """score_individual for a whole batch, returns the fitnesses in the same order
+    Only the mask tables get built one individual at a time, matching and scoring against the corpus happens for everyone at once
+    looked_up means the caller has already checked the cache for all of them, so it isn't asked again"""
+    if cache is None:
+        from evolve_population import worker_cache
+        cache = worker_cache
+    if corpus is None:
+        corpus = CORPUS_ARRAYS
+
+    fitnesses = [None] * len(genomes)
+    to_score = {} # cache key: positions in genomes, so duplicates only get scored once
+    for i, individual in enumerate(genomes):
+        if isinstance(individual, Genome) and individual.fitness is not None:
+            fitnesses[i] = individual.fitness
+            continue
+        cached_value = None if looked_up else cache.get(individual)
+        if cached_value is not None:
+            fitnesses[i] = cached_value
+            continue
+        to_score.setdefault(cache.key(individual), []).append(i)
 
-def score_individual_detailed(individual):
-    left_bank_genes, right_bank_genes = individual
+    if not to_score:
+        return fitnesses
 
-    left_bank=bank_genes_into_bank_chords(left_bank_genes)
-    right_bank=bank_genes_into_bank_chords(right_bank_genes)
+    try:
+        batch = [genomes[positions[0]] for positions in to_score.values()]
+        left_pairs, right_pairs = [], []
+        for individual in batch:
+            left_masks, right_masks = build_bank_masks(*individual_banks(individual))
+            left_pairs.append(corpus.cluster_pairs(left_masks, corpus.left_ids))
+            right_pairs.append(corpus.cluster_pairs(right_masks, corpus.right_ids))
 
-    left_masks = {
-        mask: mask_to_chords(mask, LEFT_BANK_LEN, left_bank)
-        for mask in generate_masks(LEFT_BANK_LEN)
-        if (mask_to_chords(mask, LEFT_BANK_LEN, left_bank))
-    }
+        coverages, conflicts = corpus.score_batch(len(batch), *corpus.match_batch(left_pairs, right_pairs))
 
-    right_masks = {
-        mask: mask_to_chords(mask, RIGHT_BANK_LEN, right_bank)
-        for mask in generate_masks(RIGHT_BANK_LEN)
-        if (mask_to_chords(mask, RIGHT_BANK_LEN, right_bank))
-        and not re.search(DISALLOWED_ENDINGS, mask)
-    }
+        for individual, positions, coverage, conflict in zip(batch, to_score.values(), coverages, conflicts):
+            overall_fitness = fitness_from_scores(layout_scores(float(coverage), float(conflict)))
+            cache.set(individual, overall_fitness)
+            for i in positions:
+                fitnesses[i] = overall_fitness
 
-    matches, ambiguous = find_vowel_split_matches(
-        PRONUNCIATIONS,
-        VOWELS,
-        left_masks,
-        right_masks
-    )
+    except Exception as e:
+        print("Error scoring population:", e)
+        for positions in to_score.values():
+            overall_fitness = score_individual(genomes[positions[0]], cache)
+            for i in positions:
+                fitnesses[i] = overall_fitness
 
+    return fitnesses
 
-    scores = score_layout(matches, ambiguous, PRONUNCIATIONS)
+
+
+def score_individual_detailed(individual):
+    left_bank, right_bank = individual_banks(individual)
+
+    left_masks, right_masks = build_bank_masks(left_bank, right_bank)
+    pronunciations, vowel_splits = corpus_dicts()
+
+    matches, ambiguous = match_vowel_splits(vowel_splits, left_masks, right_masks)
+
+
+    scores = score_layout(matches, ambiguous, pronunciations)
 
     alpha = 10.0   # weight coverage normally
     beta = 1.0   # penalize conflict, but not so much as to flip ranking
@@ -356,3 +528,4 @@ if __name__ == "__main__":
     print(f"\nExecution time: {elapsed:.2f} seconds")
     #lab computer: 0.75s
     #home pc: 1.14s
+    #python benchmark.py times this and everything else against saved baselines
@@ -1,41 +1,110 @@
 from default_bank import LEFT_CHORDS, LEFT_BANK_LEN, RIGHT_CHORDS, RIGHT_BANK_LEN
 from seed_population import create_initial_population_parallel
-from evolve_population import evolve_population
-from layout_fitness_measurer import FitnessCache 
-from multiprocessing import Manager
+from evolve_population import evolve_population, SURVIVAL_RATE
+from island_model import evolve_islands
+from steady_state import evolve_steady_state
+from evaluation_server import EvaluationServer, authkey_from_env, host_from_env
+from shared_fitness_cache import SharedFitnessCache
+from checkpoint import Checkpointer
+from telemetry import Telemetry
+import os
 
 
 #initial_population = create_initial_population(LEFT_BANK_LEN, RIGHT_BANK_LEN, LEFT_CHORDS, RIGHT_CHORDS, max_chords = 50, population_size = 100)
 
 if __name__ == '__main__':
-    print("creating initial population")
+    #Checkpoints every 10 generations, if the job gets preempted or hits its time limit, resubmitting it carries on from the latest one
+    #On the cluster, point CHECKPOINT_DIR somewhere that outlives the job
+    checkpointer = Checkpointer(os.environ.get("CHECKPOINT_DIR", "checkpoints"), every=10, keep=3, include_cache=True)
+    resume = checkpointer.load_latest()
 
-    initial_population = create_initial_population_parallel(
-        left_bank_length=LEFT_BANK_LEN,
-        right_bank_length=RIGHT_BANK_LEN,
-        #left_chords=LEFT_CHORDS,
-        #right_chords=RIGHT_CHORDS,
-        max_chords=40, #max_chords has to be at least 3 for crossover points
-        population_size=1000
-    )
+    if resume is not None:
+        print(f"resuming from {resume.path} at generation {resume.generation}")
+        initial_population = resume.population
+    else:
+        print("creating initial population")
 
-    print(initial_population[0])
+        initial_population = create_initial_population_parallel(
+            left_bank_length=LEFT_BANK_LEN,
+            right_bank_length=RIGHT_BANK_LEN,
+            #left_chords=LEFT_CHORDS,
+            #right_chords=RIGHT_CHORDS,
+            max_chords=40, #max_chords has to be at least 3 for crossover points
+            population_size=1000
+        )
 
-    print("Example Individual:\nleft bank:\n", initial_population[0][0], "\nright bank\n", initial_population[0][1], "\n")
+        print(initial_population[0])
 
-    print("made initial population, now onto the evolution loop")
+        print("Example Individual:\nleft bank:\n", initial_population[0][0], "\nright bank\n", initial_population[0][1], "\n")
+
+        print("made initial population, now onto the evolution loop")
 
     #Creating a cache here, so that newly spawned workers don't repeat this
     #I'm going to use this cache to keep track of individuals that have already been scored
-    manager = Manager()
-    shared_dict = manager.dict()
-    shared_cache = FitnessCache(shared_dict)
-
-
-    evolved_population, best_individual = evolve_population(
-        initial_population,
-        2000,
-        len(initial_population),
-        shared_cache
-    )
-    print("Fittest Individual\nleft bank:\n", best_individual[0], "\nright bank:\n", best_individual[1], "\n")
+    #It's in shared memory, so workers read it directly instead of going through a Manager process
+    #It's bounded, once it's full the entries that have gone unused longest get evicted (about 24 bytes a slot)
+    shared_cache = SharedFitnessCache(capacity=1 << 16)
+
+    #ISLANDS=8 splits the population into 8 islands that evolve on their own and swap their best every 10 generations
+    #(no checkpoints in island mode, each island's state lives in its own process)
+    islands = int(os.environ.get("ISLANDS", 0))
+
+    #EVALUATION_PORT=50000 scores on worker nodes instead of a local Pool, start them with
+    #python evaluation_server.py worker <this node>:50000 (with the same EVALUATION_AUTHKEY)
+    #EVALUATION_AUTHKEY has to be set, and it only listens on 127.0.0.1 unless EVALUATION_HOST is this node's cluster address
+    evaluation_port = os.environ.get("EVALUATION_PORT")
+    server = None
+    if evaluation_port:
+        server = EvaluationServer(address=(host_from_env(), int(evaluation_port)), authkey=authkey_from_env()).start()
+
+    #TELEMETRY_FILE=telemetry.jsonl writes where each generation's time went, PROFILE_GENERATION=50 also runs generation 50 under cProfile
+    telemetry_file = os.environ.get("TELEMETRY_FILE")
+    profile_generation = os.environ.get("PROFILE_GENERATION")
+    telemetry = Telemetry(telemetry_file, int(profile_generation) if profile_generation else None) if telemetry_file else None
+
+    #SCREEN_TOP_K=5000 screens children on the 5000 most likely pronunciations first, and only fully scores the ones that could survive
+    screen_top_k = int(os.environ.get("SCREEN_TOP_K", 0)) or None
+    #SURROGATE_OVERSAMPLE=3 breeds 3 times the children and lets the surrogate pick which third get scored
+    surrogate_oversample = int(os.environ.get("SURROGATE_OVERSAMPLE", 0)) or None
+
+    #STEADY_STATE=1 breeds and scores one child at a time instead of a generation at a time, with the same number of children in total
+    #(no checkpoints in steady state mode either)
+    steady_state = os.environ.get("STEADY_STATE") == "1"
+
+    try:
+        if steady_state:
+            evolved_population, best_individual = evolve_steady_state(
+                initial_population,
+                int(2000 * len(initial_population) * (1 - SURVIVAL_RATE)),
+                shared_cache
+            )
+        elif islands:
+            evolved_population, best_individual = evolve_islands(
+                initial_population,
+                2000,
+                shared_cache,
+                islands=islands,
+                migration_interval=10,
+                migrants=2,
+                topology=os.environ.get("ISLAND_TOPOLOGY", "ring")
+            )
+        else:
+            evolved_population, best_individual = evolve_population(
+                initial_population,
+                2000,
+                len(initial_population),
+                shared_cache,
+                checkpointer=checkpointer,
+                resume=resume,
+                evaluator=server.pool() if server is not None else None,
+                telemetry=telemetry,
+                screen_top_k=screen_top_k,
+                surrogate_oversample=surrogate_oversample
+            )
+        print("Fittest Individual\nleft bank:\n", best_individual[0], "\nright bank:\n", best_individual[1], "\n")
+    finally:
+        if server is not None:
+            server.shutdown()
+        if telemetry is not None:
+            telemetry.close()
+        shared_cache.close()
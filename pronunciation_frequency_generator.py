@@ -1,10 +1,15 @@
 import json
+import os
+import hashlib
+import inspect
 import pronouncing
 import math
 import re
 from wordfreq import zipf_frequency
 from tqdm import tqdm
 from collections import Counter
+from importlib.metadata import version, PackageNotFoundError
+from multiprocessing import Pool, cpu_count
 
 WORD_LIST_FILE = "words.txt"
 PRON_FREQ_FILE = "pronunciation_frequency.json"
@@ -12,6 +17,10 @@ PRON_FREQ_FILE = "pronunciation_frequency.json"
 INITIAL_CLUSTERS_FILE = "initial_clusters.json"
 FINAL_CLUSTERS_FILE = "final_clusters.json"
 
+# define_pronunciation_frequencies for every word, one file per version of the rules, so a rerun only looks up new words
+WORD_CACHE_DIR = "pronunciation_cache"
+CHUNK_SIZE = 500 # words per task for the Pool
+
 # Load or generate word list
 def load_word_list():
     pattern = re.compile(r'^[A-Za-z]+$')  # only letters and optional hyphens
@@ -252,24 +261,141 @@ def build_pronunciation_frequency(words):
     return pron_word_map, sorted_initials, sorted_finals
 
 
+def package_version(name):
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return "unknown"
+
+
+def rules_digest():
+    """Hash of everything that decides what define_pronunciation_frequencies gives for a word: its code, the vowel rules,
+    the primary weighting and the versions of the dictionaries. Change any of them and every word gets redone"""
+    parts = [
+        inspect.getsource(define_pronunciation_frequencies),
+        inspect.getsource(remove_vowels_but_keep_main),
+        repr(PRIMARY_WEIGHT),
+        package_version("pronouncing"),
+        package_version("wordfreq"),
+    ]
+    return hashlib.blake2b("\n".join(parts).encode(), digest_size=8).hexdigest()
+
+
+def word_cache_path(cache_dir=WORD_CACHE_DIR):
+    return os.path.join(cache_dir, f"words_{rules_digest()}.jsonl")
+
+
+def load_word_cache(path):
+    """{word: {pron: linear frequency}} from the cache file, a line that was cut off halfway through writing is just skipped"""
+    cached = {}
+    if not os.path.exists(path):
+        return cached
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                word, pron_freqs = json.loads(line)
+            except ValueError:
+                continue
+            cached[word] = pron_freqs
+    return cached
+
+
+def define_chunk(words):
+    return [(word, define_pronunciation_frequencies(word)) for word in words]
+
+
+def define_words(words, cache_dir=WORD_CACHE_DIR, processes=None):
+    """{word: define_pronunciation_frequencies(word)} for every word, from the cache where it can be,
+    the rest worked out in chunks by a Pool and appended to the cache as they come back"""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = word_cache_path(cache_dir)
+    results = load_word_cache(path)
+    missing = list(dict.fromkeys(word for word in words if word not in results))
+    print(f"{len(words) - len(missing)} words cached, {len(missing)} to look up")
+    if not missing:
+        return results
+
+    chunks = [missing[i:i + CHUNK_SIZE] for i in range(0, len(missing), CHUNK_SIZE)]
+    with open(path, "a", encoding="utf-8") as cache_file, Pool(processes=processes or cpu_count()) as pool:
+        with tqdm(total=len(missing), desc="Processing words", unit="word") as progress:
+            for chunk in pool.imap_unordered(define_chunk, chunks):
+                for word, pron_freqs in chunk:
+                    results[word] = pron_freqs
+                    # floats go through json exactly, so a cached word adds up the same as a fresh one
+                    cache_file.write(json.dumps([word, pron_freqs]) + "\n")
+                cache_file.flush()
+                progress.update(len(chunk))
+    return results
+
+
+def build_pronunciation_frequency_parallel(words, cache_dir=WORD_CACHE_DIR, processes=None):
+    """Same as build_pronunciation_frequency followed by keeping the most common word for each pronunciation,
+    but the words are looked up in parallel and cached (see define_words)
+    Everything is added up in word order afterwards, so the totals come out exactly the same as the serial version
+    Returns ({pron: (most common word, zipf)}, initial clusters, final clusters)"""
+    word_pron_freqs = define_words(words, cache_dir, processes)
+
+    most_common = {}
+    skipped = 0
+    initial_counter = Counter()
+    final_counter = Counter()
+
+    for word in words:
+        pron_freqs = word_pron_freqs[word]
+        if not pron_freqs:
+            skipped += 1
+            continue
+
+        for pron, freq_linear in pron_freqs.items():
+            freq_zipf = round(6 + math.log10(freq_linear), 3)
+            if freq_zipf < 1:
+                continue
+
+            # max() keeps the first of any ties, so a later word only takes over if it's strictly more common
+            # (the same word twice in the list just gets its zipf overwritten, like it would in the dict)
+            best = most_common.get(pron)
+            if best is None or best[0] == word or freq_zipf > best[1]:
+                most_common[pron] = (word, freq_zipf)
+
+            initials, finals = extract_clusters(pron)
+            for ic in initials:
+                initial_counter[ic] += freq_linear
+            for fc in finals:
+                final_counter[fc] += freq_linear
+
+    print(f"Skipped {skipped} words that did not have frequency data, writing to JSON")
+
+    sorted_initials = dict(sorted(initial_counter.items(), key=lambda x: x[1], reverse=True))
+    sorted_finals = dict(sorted(final_counter.items(), key=lambda x: x[1], reverse=True))
+
+    return most_common, sorted_initials, sorted_finals
+
+
+def write_pron_freq_map(path, most_common):
+    """Writes {pron: {word: zipf}} a pronunciation at a time, byte for byte what json.dump(..., indent=2) writes"""
+    with open(path, "w", encoding="utf-8") as f:
+        if not most_common:
+            f.write("{}")
+            return
+        f.write("{")
+        separator = "\n"
+        for pron, (word, zipf) in most_common.items():
+            f.write(f"{separator}  {json.dumps(pron)}: {{\n    {json.dumps(word)}: {json.dumps(zipf)}\n  }}")
+            separator = ",\n"
+        f.write("\n}")
+
+
 if __name__ == "__main__":
     words = load_word_list()
-    pron_freq_map, initial_clusters, final_clusters = build_pronunciation_frequency(words)
+    most_common, initial_clusters, final_clusters = build_pronunciation_frequency_parallel(words)
 
-    # Keep only the most common word for each pronunciation
+    # Keep only the most common word for each pronunciation (build_pronunciation_frequency_parallel already has)
     # This means I can make conflicts more punishing without punishing inherent conflicts like homophones/homonyms/stenonyms
-    filtered_pron_freq_map = {}
-    for pron, words_dict in pron_freq_map.items():
-        most_common_word = max(words_dict.items(), key=lambda x: x[1])
-        filtered_pron_freq_map[pron] = {most_common_word[0]: most_common_word[1]}
-    pron_freq_map = filtered_pron_freq_map
-
 
     MIN_CLUSTER_FREQ = 0.2
     initial_clusters = {c: f for c, f in initial_clusters.items() if f >= MIN_CLUSTER_FREQ}
     final_clusters   = {c: f for c, f in final_clusters.items()   if f >= MIN_CLUSTER_FREQ}
-    with open(PRON_FREQ_FILE, "w", encoding="utf-8") as f:
-        json.dump(pron_freq_map, f, indent=2)
+    write_pron_freq_map(PRON_FREQ_FILE, most_common)
     with open(INITIAL_CLUSTERS_FILE, "w", encoding="utf-8") as f:
         json.dump(initial_clusters, f, indent=2)
     with open(FINAL_CLUSTERS_FILE, "w", encoding="utf-8") as f:
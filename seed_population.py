@@ -1,9 +1,11 @@
 import random
 import copy
 
-from cluster_selection import select_initial_cluster, select_final_cluster
+import numpy as np
 
-from multiprocessing import Pool, cpu_count
+from cluster_selection import select_initial_cluster, select_final_cluster, INITIAL_SAMPLER, FINAL_SAMPLER
+from genome import Genome, intern_cluster
+from selection import generator_from_random
 
 
 def generate_chords(default_left_chords=[], default_right_chords=[], left_bank_length = 7, right_bank_length = 10, max_chords = 50):
@@ -46,16 +48,33 @@ def create_initial_population(left_bank_length, right_bank_length, left_chords=[
     return population
 
 
-#multiprocessing logic
-
-def create_individual(args):
-    return generate_chords(*args)
-
-def create_initial_population_parallel(left_bank_length, right_bank_length, left_chords=[], right_chords=[], max_chords=50, population_size=3):
-    args = [(left_chords, right_chords, left_bank_length, right_bank_length, max_chords)] * population_size
-    with Pool(processes=cpu_count()) as pool:
-        population = pool.map(create_individual, args)
-    return population
+def bank_genes(sampler, default_chords, bank_length, max_chords, population_size, rng):
+    """(clusters, masks) as population_size x max_chords arrays, the default chords first then random genes, like generate_chords"""
+    defaults = [next(iter(gene.items())) for gene in default_chords]
+    fill = max(0, max_chords - len(defaults))
+    clusters = np.empty((population_size, len(defaults) + fill), dtype=np.uint32)
+    masks = np.empty((population_size, len(defaults) + fill), dtype=np.uint16)
+    clusters[:, :len(defaults)] = [intern_cluster(cluster) for cluster, mask in defaults]
+    masks[:, :len(defaults)] = [int(mask, 2) for cluster, mask in defaults]
+    # every key pressed or not with even odds, same as picking each of '01'
+    clusters[:, len(defaults):] = sampler.draw_ids(rng, population_size * fill).reshape(population_size, fill)
+    masks[:, len(defaults):] = rng.integers(0, 1 << bank_length, size=(population_size, fill))
+    return clusters, masks
+
+
+def create_initial_population_parallel(left_bank_length, right_bank_length, left_chords=[], right_chords=[], max_chords=50, population_size=3,
+                                       rng=None):
+    """The whole population in a few array operations (it used to start a Pool to call generate_chords, which cost more than the work)
+    Returns Genomes, the numpy generator comes from the random module unless one's passed in"""
+    if rng is None:
+        rng = generator_from_random()
+    left_clusters, left_masks = bank_genes(INITIAL_SAMPLER, left_chords, left_bank_length, max_chords, population_size, rng)
+    right_clusters, right_masks = bank_genes(FINAL_SAMPLER, right_chords, right_bank_length, max_chords, population_size, rng)
+
+    clusters = np.hstack((left_clusters, right_clusters))
+    masks = np.hstack((left_masks, right_masks))
+    split = left_clusters.shape[1]
+    return [Genome.from_rows(clusters[i], masks[i], split) for i in range(population_size)]
 
 # Windows likes to have a main loop because instead of forking threats, it spawns new ones
 if __name__ == '__main__':
@@ -0,0 +1,134 @@
+"""
+Rank based selection, set up once per generation instead of once per child
+
+select_parents used to sort the survivors and rebuild its weighted keys for every child, O(n log n) a child and
+O(n^2 log n) a generation, all on the main process while the workers wait. RankSelector sorts once and builds
+an alias table over the rank weights (the best of n gets weight n, the worst 1), after which a roulette draw is O(1),
+and hands out every parent pair the generation needs in one go with numpy.
+
+The numpy generator is seeded from the random module, so a seeded run (or one resumed from a checkpoint) still picks the same parents
+"""
+import random
+
+import numpy as np
+
+METHODS = ("roulette", "tournament", "sus")
+TOURNAMENT_SIZE = 3
+
+
+def generator_from_random():
+    """A numpy Generator seeded from the random module's state, so it follows random.seed/random.setstate"""
+    return np.random.default_rng(random.getrandbits(64))
+
+
+def rank_weights(n):
+    """n for the best down to 1 for the worst, the same weights select_survivors and select_parents always used"""
+    return np.arange(n, 0, -1, dtype=np.float64)
+
+
+class AliasTable:
+    """Walker's alias method: after O(n) setup, drawing an index with probability weights[i] / sum(weights) is O(1)"""
+
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        n = len(weights)
+        if n == 0 or weights.sum() <= 0:
+            raise ValueError("Need at least one positive weight")
+        scaled = weights * (n / weights.sum())
+        self.probability = np.ones(n)
+        self.alias = np.arange(n)
+
+        small = [i for i in range(n) if scaled[i] < 1.0]
+        large = [i for i in range(n) if scaled[i] >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large[-1]
+            self.probability[s] = scaled[s]
+            self.alias[s] = l
+            # the large one gives up what it took to fill the small one's column
+            scaled[l] -= 1.0 - scaled[s]
+            if scaled[l] < 1.0:
+                small.append(large.pop())
+        # whatever's left is 1 give or take rounding, so it's always itself
+
+    def __len__(self):
+        return len(self.probability)
+
+    def draw(self, rng, size):
+        columns = rng.integers(0, len(self.probability), size=size)
+        keep = rng.random(size) < self.probability[columns]
+        return np.where(keep, columns, self.alias[columns])
+
+
+class RankSelector:
+    """Survivors ranked by fitness, best first, ready to draw from with any of METHODS
+    Draws are positions in self.ranked"""
+
+    def __init__(self, individuals, fitnesses, rng=None):
+        order = sorted(range(len(individuals)), key=lambda i: fitnesses[i], reverse=True)
+        self.ranked = [individuals[i] for i in order]
+        self.ranked_fitnesses = [fitnesses[i] for i in order]
+        self.weights = rank_weights(len(order))
+        self.cumulative = np.cumsum(self.weights)
+        self.table = AliasTable(self.weights) if order else None
+        self.rng = rng if rng is not None else generator_from_random()
+
+    def __len__(self):
+        return len(self.ranked)
+
+    def roulette(self, size):
+        """size ranks, each with probability proportional to its rank weight"""
+        return self.table.draw(self.rng, size)
+
+    def tournament(self, size, tournament_size=TOURNAMENT_SIZE):
+        """size ranks, each the best of tournament_size picked uniformly (with replacement)"""
+        return self.rng.integers(0, len(self.ranked), size=(size, tournament_size)).min(axis=1)
+
+    def sus(self, size):
+        """size ranks by stochastic universal sampling: evenly spaced pointers from one random start over the cumulative weights,
+        so everyone gets within one of their expected number of picks. Comes out in rank order"""
+        step = self.cumulative[-1] / size
+        pointers = self.rng.random() * step + step * np.arange(size)
+        return np.searchsorted(self.cumulative, pointers, side="right")
+
+    def draw(self, size, method="roulette"):
+        if method == "roulette":
+            return self.roulette(size)
+        if method == "tournament":
+            return self.tournament(size)
+        if method == "sus":
+            return self.sus(size)
+        raise ValueError(f"Unknown selection method {method!r}, expected one of {METHODS}")
+
+    def survivors(self, count):
+        """count distinct individuals, weighted by rank without replacement (Efraimidis-Spirakis keys, like select_survivors)
+        Returns [(individual, fitness)] in key order"""
+        keys = np.log(self.rng.random(len(self.ranked))) / self.weights
+        order = np.argsort(-keys, kind="stable")[:count]
+        return [(self.ranked[i], self.ranked_fitnesses[i]) for i in order.tolist()]
+
+    def parent_pairs(self, count, method="roulette"):
+        """count (parent1, parent2) pairs, never the same individual twice in a pair
+        For roulette, redrawing the second parent until it's different gives exactly the distribution of
+        drawing two without replacement, which is what select_parents did"""
+        if len(self.ranked) < 2:
+            raise ValueError("Need at least two survivors to pick parents from")
+        if count <= 0:
+            return []
+
+        if method == "sus":
+            # one sweep for every parent needed, shuffled into pairs
+            picks = self.rng.permutation(self.sus(2 * count))
+            first, second = picks[:count], picks[count:]
+        else:
+            first = self.draw(count, method)
+            second = self.draw(count, method)
+
+        clashes = np.flatnonzero(first == second)
+        while len(clashes):
+            redraw = self.draw(len(clashes), "roulette" if method == "sus" else method)
+            second[clashes] = redraw
+            clashes = clashes[redraw == first[clashes]]
+
+        ranked = self.ranked
+        return [(ranked[i], ranked[j]) for i, j in zip(first.tolist(), second.tolist())]
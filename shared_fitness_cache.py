@@ -0,0 +1,273 @@
+"""
+A fitness cache that lives in shared memory, rather than behind a Manager().dict()
+
+With the Manager, every get/set is a round trip to the manager process with the whole nested key pickled,
+so with every core scoring at once the manager ends up being the bottleneck.
+Here every process maps the same block of memory: a fixed number of slots, each holding a 64 bit hash of the genome,
+its fitness, and the generation it was last used in.
+Reads don't take the lock at all, only writes do (so two workers can't claim the same empty slot)
+
+It's bounded rather than pruned every generation, when a new fitness has nowhere to go the slot that's gone unused the longest
+gets evicted, so individuals the GA rediscovers a few generations later are often still in there
+"""
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from layout_fitness_measurer import FitnessCache
+from genome import Genome, key_digest
+
+EMPTY = 0 # a slot with this hash is free, so real hashes are never allowed to be 0
+
+# header: the current generation, (unused), the total evictions
+GENERATION, EVICTIONS = 0, 2
+HEADER_LEN = 8
+
+# Hits and misses happen without the lock, so each process counts into its own row to avoid losing counts
+# A row belongs to whichever pid claimed it, and goes back up for grabs once that process is gone (the Pool restarts its
+# workers every maxtasksperchild tasks, so plenty of processes come and go). Whoever can't get a row of their own
+# counts into the last one, which only ever gets added to under the lock
+STATS_ROWS = 64
+SHARED_ROW = STATS_ROWS - 1
+HITS, MISSES, OWNER = range(3)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True # it's there, just not ours
+    return True
+
+
+class SharedFitnessCache(FitnessCache):
+    def __init__(self, capacity=1 << 16, max_probes=32):
+        """capacity is rounded up to a power of 2
+        A new fitness has to go in one of the max_probes slots after the one its hash points at, the oldest of those gets evicted if they're all taken"""
+        self.capacity = 1 << max(0, (capacity - 1).bit_length())
+        self.max_probes = max_probes
+        self.lock = multiprocessing.Lock()
+        self.shm = shared_memory.SharedMemory(create=True, size=self._size())
+        self.owner = True
+        self._attach()
+        self.header[:] = 0
+        self.counts[:] = 0
+        self.hashes[:] = EMPTY
+        self.counts[0, OWNER] = os.getpid() # row 0 is this process's
+        self.stats_row = 0
+        self.stats_pid = os.getpid()
+        self.last_totals = (0, 0, 0)
+
+    def _size(self):
+        return (HEADER_LEN + STATS_ROWS * 3) * 8 + self.capacity * 24
+
+    def _attach(self):
+        # header, per process hit/miss counts, then the hashes, fitnesses and last used generation of every slot
+        buf = self.shm.buf
+        offset = 0
+        self.header = np.ndarray((HEADER_LEN,), dtype=np.int64, buffer=buf, offset=offset)
+        offset += HEADER_LEN * 8
+        self.counts = np.ndarray((STATS_ROWS, 3), dtype=np.int64, buffer=buf, offset=offset)
+        offset += STATS_ROWS * 3 * 8
+        self.hashes = np.ndarray((self.capacity,), dtype=np.uint64, buffer=buf, offset=offset)
+        offset += self.capacity * 8
+        self.values = np.ndarray((self.capacity,), dtype=np.float64, buffer=buf, offset=offset)
+        offset += self.capacity * 8
+        self.last_used = np.ndarray((self.capacity,), dtype=np.int64, buffer=buf, offset=offset)
+
+    # When this gets sent to a spawned worker, it reattaches to the same block by name instead of copying it
+    def __getstate__(self):
+        return {"name": self.shm.name, "capacity": self.capacity, "max_probes": self.max_probes, "lock": self.lock}
+
+    def __setstate__(self, state):
+        self.capacity = state["capacity"]
+        self.max_probes = state["max_probes"]
+        self.lock = state["lock"]
+        self.shm = shared_memory.SharedMemory(name=state["name"])
+        self.owner = False
+        self.stats_row = None # until claim_stats_row, counts go in the shared row
+        self.stats_pid = None
+        self._attach()
+
+    def claim_stats_row(self):
+        """Give this process its own row to count hits and misses in, called from each worker's initializer
+        Calling it again from the same process keeps the row it already has"""
+        pid = os.getpid()
+        with self.lock:
+            for row in range(SHARED_ROW):
+                owner = int(self.counts[row, OWNER])
+                if owner == pid:
+                    self.stats_row, self.stats_pid = row, pid
+                    return
+            for row in range(SHARED_ROW):
+                owner = int(self.counts[row, OWNER])
+                if owner == 0 or not pid_alive(owner):
+                    # the counts already in it stay, they're still part of the totals
+                    self.counts[row, OWNER] = pid
+                    self.stats_row, self.stats_pid = row, pid
+                    return
+        self.stats_row = None # every row's taken by a live process
+
+    def _count(self, hits, misses):
+        # a process forked off with a copy of this (without claiming a row) mustn't count into its parent's row
+        if self.stats_row is not None and self.stats_pid == os.getpid():
+            self.counts[self.stats_row, HITS] += hits
+            self.counts[self.stats_row, MISSES] += misses
+        else:
+            with self.lock:
+                self.counts[SHARED_ROW, HITS] += hits
+                self.counts[SHARED_ROW, MISSES] += misses
+
+    @property
+    def cache(self):
+        # The Manager version hands its dict out to workers, this one hands out itself
+        return self
+
+    def genome_hash(self, individual):
+        if isinstance(individual, Genome):
+            return individual.digest()
+        return key_digest(self.key(individual))
+
+    def _slots(self, genome_hash):
+        # linear probing, starting from the slot the hash points at
+        start = genome_hash & (self.capacity - 1)
+        for probe in range(min(self.max_probes, self.capacity)):
+            yield (start + probe) & (self.capacity - 1)
+
+    def get(self, individual):
+        genome_hash = self.genome_hash(individual)
+        for slot in self._slots(genome_hash):
+            slot_hash = int(self.hashes[slot])
+            if slot_hash == EMPTY:
+                break
+            if slot_hash == genome_hash:
+                value = float(self.values[slot])
+                # if it got evicted while I was reading, the value might belong to someone else now
+                if int(self.hashes[slot]) != genome_hash:
+                    break
+                self.last_used[slot] = self.header[GENERATION]
+                self._count(1, 0)
+                return value
+        self._count(0, 1)
+        return None
+
+    def get_many(self, individuals):
+        """get for a whole batch at once, every probe is one array operation over all of them rather than a loop per individual"""
+        if not individuals:
+            return []
+        genome_hashes = np.fromiter((self.genome_hash(ind) for ind in individuals), dtype=np.uint64, count=len(individuals))
+        starts = (genome_hashes & np.uint64(self.capacity - 1)).astype(np.int64)
+        values = np.zeros(len(individuals))
+        found = np.zeros(len(individuals), dtype=bool)
+        searching = np.ones(len(individuals), dtype=bool)
+        for probe in range(min(self.max_probes, self.capacity)):
+            slots = (starts + probe) & (self.capacity - 1)
+            slot_hashes = self.hashes[slots]
+            hits = searching & (slot_hashes == genome_hashes)
+            values[hits] = self.values[slots[hits]]
+            # same as get, anything evicted while I was reading doesn't count
+            hits &= self.hashes[slots] == genome_hashes
+            self.last_used[slots[hits]] = self.header[GENERATION]
+            found |= hits
+            searching &= ~hits & (slot_hashes != EMPTY)
+            if not searching.any():
+                break
+        hits = int(found.sum())
+        self._count(hits, len(individuals) - hits)
+        return [float(value) if hit else None for value, hit in zip(values, found)]
+
+    def set(self, individual, value):
+        self._insert(self.genome_hash(individual), value)
+
+    def _insert(self, genome_hash, value, last_used=None):
+        if last_used is None:
+            last_used = self.header[GENERATION]
+        with self.lock:
+            oldest = None
+            for slot in self._slots(genome_hash):
+                slot_hash = int(self.hashes[slot])
+                if slot_hash == EMPTY or slot_hash == genome_hash:
+                    break
+                if oldest is None or self.last_used[slot] < self.last_used[oldest]:
+                    oldest = slot
+            else:
+                # nowhere free, so whatever has gone unused the longest makes way
+                slot = oldest
+                self.header[EVICTIONS] += 1
+                # clear it first, so nobody reads the old hash alongside the new value
+                self.hashes[slot] = EMPTY
+
+            # value first, so a reader that sees the hash is guaranteed to see the value with it
+            self.values[slot] = value
+            self.last_used[slot] = last_used
+            self.hashes[slot] = genome_hash
+
+    def __len__(self):
+        return int(np.count_nonzero(self.hashes != EMPTY))
+
+    def stats(self):
+        """Totals since the cache was made"""
+        hits, misses = (int(n) for n in self.counts[:, [HITS, MISSES]].sum(axis=0))
+        entries = len(self)
+        return {
+            "hits": hits,
+            "misses": misses,
+            "evictions": int(self.header[EVICTIONS]),
+            "entries": entries,
+            "load": entries / self.capacity,
+            "memory_bytes": self.shm.size,
+        }
+
+    def generation_stats(self):
+        """Same as stats, but hits/misses/evictions only count since the last time this was called"""
+        stats = self.stats()
+        totals = (stats["hits"], stats["misses"], stats["evictions"])
+        stats["hits"], stats["misses"], stats["evictions"] = (now - before for now, before in zip(totals, self.last_totals))
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        self.last_totals = totals
+        return stats
+
+    def end_generation(self, population):
+        """Nothing gets pruned any more, the clock just moves on so this generation's entries start ageing"""
+        self.header[GENERATION] += 1
+
+    def prune(self, population):
+        """Only keep the fitnesses of the given individuals
+        Rebuilds the table, so only call this while no workers are reading from it (between generations)"""
+        keep = {self.genome_hash(ind) for ind in population}
+        with self.lock:
+            occupied = np.flatnonzero(self.hashes != EMPTY)
+            kept = [(int(self.hashes[slot]), float(self.values[slot]), int(self.last_used[slot]))
+                    for slot in occupied if int(self.hashes[slot]) in keep]
+            self.hashes[:] = EMPTY
+        for genome_hash, value, last_used in kept:
+            self._insert(genome_hash, value, last_used)
+
+    def snapshot(self):
+        """Copies of every occupied slot, for saving in a checkpoint"""
+        occupied = np.flatnonzero(self.hashes != EMPTY)
+        return {
+            "hashes": self.hashes[occupied].copy(),
+            "values": self.values[occupied].copy(),
+            "last_used": self.last_used[occupied].copy(),
+            "generation": np.array(self.header[GENERATION]),
+        }
+
+    def restore(self, snapshot):
+        """Put back what snapshot took, on top of whatever's already in here
+        The oldest go in first, so if this cache is smaller than the one the snapshot came from, they're the ones that get evicted"""
+        self.header[GENERATION] = max(int(self.header[GENERATION]), int(snapshot["generation"]))
+        for slot in np.argsort(snapshot["last_used"], kind="stable"):
+            self._insert(int(snapshot["hashes"][slot]), float(snapshot["values"][slot]), int(snapshot["last_used"][slot]))
+
+    def close(self):
+        """Detach from the shared memory, and if this is the process that made it, free it too"""
+        self.header = self.counts = self.hashes = self.values = self.last_used = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
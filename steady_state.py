@@ -0,0 +1,126 @@
+"""
+Steady state mode: no generations, so no waiting on the slowest individual and no cores sat idle while the main process breeds
+
+There are always a couple of children per worker in the Pool. Whenever one comes back it goes straight into the population
+in place of the worst individual (if it beats them), and another child is sent off, so the workers never run out of something to do.
+Parents are picked the same way as in evolve_population, by rank, and children are bred and mutated the same way too,
+scored from whichever parent they're closest to. Ranking the population and mutating one child at a time would
+cost the main process more than a worker takes to score one, so children are bred a batch at a time (enough to refill
+every worker) from the population as it was then, and sent off from there as places free up
+
+Results come back in whatever order the workers finish them, so even with a seed two runs won't come out the same
+"""
+import queue
+import time
+from collections import deque
+from multiprocessing import Pool, cpu_count
+
+from tqdm import tqdm
+
+from genome import as_genome
+from evolve_population import (breed, mutate_children, closest_parent, score_generation, init_worker, evaluations_per_hour, GENES_TO_MUTATE,
+                               format_cache_stats, SURVIVAL_RATE)
+from incremental_scoring import score_family
+from diversity import population_diversity
+from layout_fitness_measurer import score_individual_detailed
+from selection import RankSelector, generator_from_random
+
+IN_FLIGHT_PER_WORKER = 2 # one being scored, one waiting, so a worker never waits on the main process
+
+
+def evolve_steady_state(population, number_of_evaluations, shared_cache, workers=None, selection="roulette",
+                        in_flight_per_worker=IN_FLIGHT_PER_WORKER):
+    """Same job as evolve_population, but one child at a time rather than a generation at a time
+    number_of_evaluations is how many children get scored in total, population_size * (1 - SURVIVAL_RATE) of them
+    is what one generation of evolve_population scores, so that's what the progress gets reported every
+    Returns the final population and the best individual"""
+    population = [as_genome(ind) for ind in population]
+    population_size = len(population)
+    report_every = max(1, int(population_size * (1 - SURVIVAL_RATE)))
+    if workers is None:
+        workers = cpu_count()
+    rng = generator_from_random()
+
+    results = queue.Queue() # the Pool's result thread puts finished children in here, everything else happens on this thread
+    evaluations = 0
+    cache_hits = 0
+    in_flight = 0
+
+    with Pool(processes=workers, maxtasksperchild=200, initializer=init_worker, initargs=(shared_cache,)) as pool:
+        # the first population gets scored all at once, there's nothing to breed from until it has been
+        start = time.perf_counter()
+        population_fitnesses = score_generation(pool, population, {}, workers, cache=shared_cache)
+        evaluations += population_size
+        keys = {ind.key() for ind in population}
+        nursery = deque() # (child, parent1, parent2) bred but not sent yet
+        batch_size = workers * in_flight_per_worker
+
+        def submit():
+            """Send the next child off, unless it's already known"""
+            nonlocal in_flight, cache_hits
+            if not nursery:
+                parent_pairs = RankSelector(population, population_fitnesses).parent_pairs(batch_size, selection)
+                children = mutate_children([breed(parent1, parent2) for parent1, parent2 in parent_pairs], GENES_TO_MUTATE, rng)
+                nursery.extend((child, parent1, parent2) for child, (parent1, parent2) in zip(children, parent_pairs))
+            child, parent1, parent2 = nursery.popleft()
+            if child.key() in keys:
+                # it's already in the population, breeding it again doesn't need scoring or a place
+                return
+            fitness = shared_cache.get(child)
+            if fitness is not None:
+                cache_hits += 1
+                results.put((child, fitness))
+                in_flight += 1
+                return
+            parent = closest_parent(child, parent1, parent2)
+            pool.apply_async(score_family, (parent, [child], None, None), {"looked_up": True},
+                             callback=lambda scores, child=child: results.put((child, scores[0])),
+                             error_callback=lambda error, child=child: results.put((child, error)))
+            in_flight += 1
+
+        with tqdm(total=number_of_evaluations, desc="Evolving (steady state)", unit="eval") as progress:
+            scored = 0
+            while scored < number_of_evaluations:
+                while in_flight < workers * in_flight_per_worker and scored + in_flight < number_of_evaluations:
+                    submit()
+
+                child, fitness = results.get()
+                in_flight -= 1
+                if isinstance(fitness, Exception):
+                    print("Error scoring child:", fitness)
+                    continue
+                child.fitness = fitness
+                scored += 1
+                evaluations += 1
+                progress.update(1)
+
+                # it takes the place of the worst, as long as it's better and isn't already in there
+                worst = min(range(population_size), key=population_fitnesses.__getitem__)
+                if fitness > population_fitnesses[worst] and child.key() not in keys:
+                    keys.discard(population[worst].key())
+                    keys.add(child.key())
+                    population[worst] = child
+                    population_fitnesses[worst] = fitness
+
+                if scored % report_every == 0:
+                    # every generation's worth of children, same as evolve_population writes
+                    diversity = population_diversity(population)
+                    best = max(population_fitnesses)
+                    avg = sum(population_fitnesses) / population_size
+                    tqdm.write(f"Evaluation {scored}: best={best}, avg={avg}, similarity={diversity['similarity']:.4f}, entropy={diversity['entropy']:.3f}")
+                    tqdm.write(f"    cache: {format_cache_stats(shared_cache.generation_stats())}, answered here: {cache_hits}")
+                    shared_cache.end_generation(population)
+
+            # anything still being scored isn't needed
+            while in_flight:
+                results.get()
+                in_flight -= 1
+        elapsed = time.perf_counter() - start
+
+    best_fitness = max(population_fitnesses)
+    best_individual = population[population_fitnesses.index(best_fitness)]
+
+    print(f"Final population: best={best_fitness}, avg={sum(population_fitnesses)/population_size}")
+    print(f"{evaluations} evaluations in {elapsed:.1f}s, {evaluations_per_hour(evaluations, elapsed):,.0f} per hour")
+    score_individual_detailed(best_individual)
+    return population, best_individual
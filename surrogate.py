@@ -0,0 +1,101 @@
+"""
+A cheap stand-in for the fitness function, to decide which children are worth scoring properly
+
+Every gene becomes a handful of features: (bank, cluster, key) for each key its mask presses, and (bank, cluster) for the cluster
+being there at all, hashed down to a fixed number of columns. A ridge regression over those is trained online on every
+(genome, fitness) the GA scores, forgetting old generations a bit at a time since the population keeps moving on.
+
+next_generation breeds several times as many children as it needs, the surrogate ranks them, and only the best (plus a few
+picked at random, so the surrogate still gets to see what it's wrong about) go on to be scored properly.
+How well its ranking matches the real one is worth keeping an eye on, rank_correlation gives that for every generation
+"""
+import numpy as np
+
+from diversity import gene_matrices
+from genome import Genome
+
+FEATURE_BITS = 10 # 1024 hashed columns
+PRESENT = 15 # the "key" used for the cluster being there at all
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def gene_features(population, feature_bits=FEATURE_BITS):
+    """n x 2**feature_bits counts of each hashed (bank, cluster, key) feature, plus a constant column at the end"""
+    clusters, masks, split = gene_matrices(population)
+    n, length = clusters.shape
+    columns = 1 << feature_bits
+    bank = np.zeros(length, dtype=np.uint64)
+    bank[split:] = 1
+    widths = np.array(Genome.BANK_LENS, dtype=np.uint64)[bank.astype(np.int64)]
+
+    # every (gene, key) that's pressed, plus one PRESENT feature per gene
+    base = (clusters << np.uint64(5)) | (bank << np.uint64(4))
+    keys = np.arange(max(Genome.BANK_LENS), dtype=np.uint64)
+    pressed = ((masks[:, :, None] >> keys) & np.uint64(1)).astype(bool) & (keys < widths[:, None])
+    rows = np.broadcast_to(np.arange(n)[:, None, None], pressed.shape)[pressed]
+    features = (base[:, :, None] | keys)[pressed]
+    rows = np.concatenate((rows, np.repeat(np.arange(n), length)))
+    features = np.concatenate((features, (base | np.uint64(PRESENT)).ravel()))
+
+    # multiply-shift hash down to the columns
+    hashed = ((features * HASH_MULTIPLIER) >> np.uint64(64 - feature_bits)).astype(np.int64)
+    matrix = np.bincount(rows * (columns + 1) + hashed, minlength=n * (columns + 1)).reshape(n, columns + 1).astype(np.float64)
+    matrix[:, columns] = 1.0
+    return matrix
+
+
+def rank_correlation(predicted, actual):
+    """Spearman's rank correlation (ties broken by order, which is fine for floats like these)"""
+    if len(predicted) < 2:
+        return float("nan")
+    predicted_ranks = np.argsort(np.argsort(predicted)).astype(np.float64)
+    actual_ranks = np.argsort(np.argsort(actual)).astype(np.float64)
+    predicted_ranks -= predicted_ranks.mean()
+    actual_ranks -= actual_ranks.mean()
+    spread = np.sqrt((predicted_ranks ** 2).sum() * (actual_ranks ** 2).sum())
+    return float((predicted_ranks * actual_ranks).sum() / spread) if spread > 0 else float("nan")
+
+
+class Surrogate:
+    def __init__(self, feature_bits=FEATURE_BITS, ridge=1.0, forgetting=0.9):
+        """ridge is how hard the weights get pulled towards 0, forgetting is how much each update keeps of what came before"""
+        self.feature_bits = feature_bits
+        self.ridge = ridge
+        self.forgetting = forgetting
+        columns = (1 << feature_bits) + 1
+        self.gram = np.zeros((columns, columns)) # X^T X, decayed
+        self.moments = np.zeros(columns) # X^T y, decayed
+        self.weights = None
+        self.samples = 0
+
+    @property
+    def trained(self):
+        return self.weights is not None
+
+    def update(self, genomes, fitnesses):
+        """Learn from genomes that have been scored properly (anything with a fitness of None is skipped)"""
+        scored = [(genome, fitness) for genome, fitness in zip(genomes, fitnesses) if fitness is not None]
+        if not scored:
+            return
+        features = gene_features([genome for genome, _ in scored], self.feature_bits)
+        targets = np.array([fitness for _, fitness in scored])
+        self.gram = self.forgetting * self.gram + features.T @ features
+        self.moments = self.forgetting * self.moments + features.T @ targets
+        self.samples += len(scored)
+
+        regularised = self.gram + self.ridge * np.eye(len(self.moments))
+        regularised[-1, -1] -= self.ridge # the constant column doesn't get pulled towards 0
+        self.weights = np.linalg.solve(regularised, self.moments)
+
+    def predict(self, genomes):
+        return gene_features(genomes, self.feature_bits) @ self.weights
+
+    def choose(self, candidates, count, rng, explore=0.2):
+        """Positions of the count candidates to score properly: the best predicted, and explore of them picked at random from the rest"""
+        if count >= len(candidates):
+            return list(range(len(candidates)))
+        order = np.argsort(-self.predict(candidates), kind="stable")
+        exploring = min(int(count * explore), len(candidates) - count)
+        best = order[:count - exploring]
+        others = rng.choice(order[count - exploring:], size=exploring, replace=False)
+        return sorted(np.concatenate((best, others)).tolist())
@@ -0,0 +1,255 @@
+"""
+Hyperparameter sweeps, rather than editing the numbers by hand and rerunning
+
+A spec (JSON) says which knobs to vary and how, every setting gets its own run of evolve_population, and as many runs go at once
+as there are cores to give them (each run scores its own population in its own process, one core each).
+The compiled corpus is a memory map, so every run shares its pages anyway. What's built from it, the screening
+sub-corpus for each screen_top_k in the sweep, gets built once before the runs are forked off, so they share that too
+rather than each building their own. Every run gets its own fitness cache though, since different fitness settings
+give different fitnesses for the same layout.
+
+{
+    "mode": "grid",                 grid tries every combination, random draws "samples" settings
+    "samples": 20,
+    "seed": 0,                      for drawing random settings, and the first run's seed
+    "repeats": 1,                   runs per setting, each with the next seed along
+    "base": {"generations": 50},    anything not varied that shouldn't be the default
+    "parameters": {
+        "population_size": [100, 200],              a list is picked from
+        "survival_rate": {"min": 0.3, "max": 0.7},  a range is drawn from uniformly (whole numbers if both ends are)
+        "alpha": {"min": 5, "max": 20, "log": true} log spaced
+    }
+}
+Grids only take lists. Anything in DEFAULTS can be varied. Every run has to keep at least 2 survivors
+(population_size * survival_rate) to breed from and have max_chords of at least 3, a spec with any run that doesn't is rejected
+before anything starts.
+
+python sweep.py sweep_spec.json --cores 8 --out sweeps/first
+
+Every run writes its output to run_<n>.log and its generations to run_<n>.jsonl (see telemetry.py), and a line to results.jsonl
+as soon as it finishes (so a sweep that gets killed still has everything done so far). results.csv is written at the end,
+best first, with each run's best layout as JSON in its best_layout column. fitness is what the run was maximising,
+which isn't comparable between different fitness settings, so every best layout gets scored with the default settings too (default_fitness), along with its coverage and conflict ratio
+"""
+import argparse
+import csv
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import time
+from contextlib import redirect_stdout, redirect_stderr
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+
+from default_bank import LEFT_BANK_LEN, RIGHT_BANK_LEN
+from evolve_population import evolve_population, init_worker, SURVIVAL_RATE, GENES_TO_MUTATE
+from incremental_scoring import screen_corpus
+from island_model import InlinePool
+from layout_fitness_measurer import (FitnessCache, FITNESS_PARAMS, DEFAULT_FITNESS_PARAMS, set_fitness_params, fitness_from_scores,
+                                     score_layout_arrays, build_bank_masks, individual_banks)
+from seed_population import create_initial_population_parallel
+from telemetry import Telemetry
+
+# what main.py runs with
+DEFAULTS = {
+    "max_chords": 40,
+    "population_size": 1000,
+    "generations": 2000,
+    "survival_rate": SURVIVAL_RATE,
+    "genes_to_mutate": GENES_TO_MUTATE,
+    "screen_top_k": None, # screening off
+    **DEFAULT_FITNESS_PARAMS,
+}
+MODES = ("grid", "random")
+RESULT_COLUMNS = ("run", "seed", *DEFAULTS, "fitness", "default_fitness", "coverage_prob", "conflict_ratio", "avg_fitness",
+                  "wall_seconds", "error", "best_layout")
+MIN_SURVIVORS = 2 # someone to breed with
+MIN_CHORDS = 3 # for the crossover points
+
+
+class InlineEvaluator(InlinePool):
+    """Scores in the run's own process, evolve_population takes it in place of a Pool"""
+    def workers(self):
+        return 1
+
+
+def sample_value(spec, rng):
+    if isinstance(spec, list):
+        return spec[rng.randrange(len(spec))]
+    low, high = spec["min"], spec["max"]
+    if spec.get("log"):
+        value = math.exp(rng.uniform(math.log(low), math.log(high)))
+    else:
+        value = rng.uniform(low, high)
+    return round(value) if isinstance(low, int) and isinstance(high, int) else value
+
+
+def grid_settings(parameters):
+    for name, values in parameters.items():
+        if not isinstance(values, list):
+            raise ValueError(f"A grid needs a list of values for {name}, got {values!r}")
+    names = list(parameters)
+    return [dict(zip(names, values)) for values in itertools.product(*(parameters[name] for name in names))]
+
+
+def random_settings(parameters, samples, rng):
+    return [{name: sample_value(spec, rng) for name, spec in parameters.items()} for _ in range(samples)]
+
+
+def load_spec(path):
+    """[(run number, seed, config)] for every run the spec asks for, a config being DEFAULTS with the spec's changes"""
+    with open(path) as f:
+        spec = json.load(f)
+    mode = spec.get("mode", "grid")
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode {mode!r}, expected one of {MODES}")
+    parameters = spec.get("parameters", {})
+    base = spec.get("base", {})
+    unknown = (set(parameters) | set(base)) - set(DEFAULTS)
+    if unknown:
+        raise ValueError(f"Unknown parameter(s) {sorted(unknown)}, expected some of {list(DEFAULTS)}")
+
+    seed = spec.get("seed", 0)
+    if mode == "grid":
+        settings = grid_settings(parameters)
+    else:
+        settings = random_settings(parameters, spec.get("samples", 10), random.Random(seed))
+
+    runs = []
+    for setting in settings:
+        for repeat in range(spec.get("repeats", 1)):
+            runs.append((len(runs), seed + repeat, {**DEFAULTS, **base, **setting}))
+    check_runs(runs)
+    return runs
+
+
+def check_runs(runs):
+    """ValueError listing every run that couldn't get going, rather than finding out halfway through the sweep"""
+    problems = []
+    for run, seed, config in runs:
+        survivors = int(config["population_size"] * config["survival_rate"])
+        if survivors < MIN_SURVIVORS:
+            problems.append(f"run {run}: population_size {config['population_size']} * survival_rate {config['survival_rate']} "
+                            f"leaves {survivors} survivor(s), it needs at least {MIN_SURVIVORS}")
+        if config["max_chords"] < MIN_CHORDS:
+            problems.append(f"run {run}: max_chords is {config['max_chords']}, it needs to be at least {MIN_CHORDS}")
+    if problems:
+        raise ValueError("Some of the runs can't work:\n" + "\n".join(problems))
+
+
+def run_config(run, seed, config, out_dir):
+    """One GA run with config, in a process of its own. Returns its row of the results table"""
+    row = {"run": run, "seed": seed, **config}
+    start = time.perf_counter()
+    with open(os.path.join(out_dir, f"run_{run}.log"), "w") as log, redirect_stdout(log), redirect_stderr(log):
+        try:
+            print(f"run {run}, seed {seed}: {json.dumps(config)}")
+            set_fitness_params(**{name: config[name] for name in FITNESS_PARAMS})
+            random.seed(seed)
+            population = create_initial_population_parallel(LEFT_BANK_LEN, RIGHT_BANK_LEN, max_chords=config["max_chords"],
+                                                            population_size=config["population_size"],
+                                                            rng=np.random.default_rng(seed))
+            cache = FitnessCache()
+            init_worker(cache)
+            with Telemetry(os.path.join(out_dir, f"run_{run}.jsonl")) as telemetry:
+                population, best_individual = evolve_population(
+                    population, config["generations"], config["population_size"], cache,
+                    evaluator=InlineEvaluator(), telemetry=telemetry,
+                    screen_top_k=config["screen_top_k"],
+                    survival_rate=config["survival_rate"], genes_to_mutate=config["genes_to_mutate"])
+
+            scores = score_layout_arrays(*build_bank_masks(*individual_banks(best_individual)))
+            fitnesses = [ind.fitness for ind in population]
+            row.update({
+                "fitness": best_individual.fitness,
+                "default_fitness": fitness_from_scores(scores, DEFAULT_FITNESS_PARAMS),
+                "coverage_prob": scores["coverage_prob"],
+                "conflict_ratio": scores["conflict_ratio"],
+                "avg_fitness": sum(fitnesses) / len(fitnesses),
+                "best_layout": best_individual.to_individual(),
+            })
+        except Exception as e:
+            # one bad setting shouldn't take the rest of the sweep down with it
+            print("Error in run:", repr(e))
+            row["error"] = repr(e)
+    row["wall_seconds"] = time.perf_counter() - start
+    return row
+
+
+def run_config_args(args):
+    return run_config(*args)
+
+
+def warm_up(runs):
+    """Build what the runs can share before they're forked off: the screening sub-corpus for every screen_top_k they use
+    (the compiled corpus itself is mapped in on import, and shared by every process that maps it)"""
+    for top_k in {config["screen_top_k"] for _, _, config in runs if config["screen_top_k"]}:
+        screen_corpus(top_k)
+
+
+def write_table(rows, path):
+    """results.csv, best default_fitness first (runs that failed at the end)"""
+    rows = sorted(rows, key=lambda row: (row.get("default_fitness") is None, -(row.get("default_fitness") or 0)))
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+        for row in rows:
+            # the layout as JSON, so it can be got back out of the table
+            writer.writerow({**row, "best_layout": json.dumps(row["best_layout"]) if "best_layout" in row else ""})
+    return rows
+
+
+def print_table(rows, varied, top=10):
+    columns = ["run", "seed", *varied, "default_fitness", "coverage_prob", "conflict_ratio", "wall_seconds"]
+    print("  ".join(f"{column:>14}" for column in columns))
+    for row in rows[:top]:
+        values = []
+        for column in columns:
+            value = row.get(column)
+            values.append(f"{value:>14.6g}" if isinstance(value, float) else f"{str(value if value is not None else '-'):>14}")
+        print("  ".join(values))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run GA settings from a grid or random search spec, several at once")
+    parser.add_argument("spec", help="JSON sweep spec (see the top of sweep.py)")
+    parser.add_argument("--cores", type=int, default=cpu_count(), help="how many runs go at once, a core each")
+    parser.add_argument("--out", help="where the logs and results go (default sweeps/<time>)")
+    parser.add_argument("--dry-run", action="store_true", help="just list the runs")
+    args = parser.parse_args(argv)
+
+    runs = load_spec(args.spec)
+    varied = [name for name in DEFAULTS if len({repr(config[name]) for _, _, config in runs}) > 1]
+    if args.dry_run:
+        for run, seed, config in runs:
+            print(run, seed, {name: config[name] for name in varied})
+        return 0
+
+    out_dir = args.out or os.path.join("sweeps", time.strftime("%Y%m%d-%H%M%S"))
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, "spec.json"), "w") as f:
+        json.dump({"spec": args.spec, "runs": runs}, f, indent=2)
+
+    print(f"{len(runs)} runs, {min(args.cores, len(runs))} at a time, writing to {out_dir}")
+    warm_up(runs)
+    rows = []
+    with open(os.path.join(out_dir, "results.jsonl"), "a", encoding="utf-8") as results, \
+            Pool(processes=max(1, min(args.cores, len(runs))), maxtasksperchild=1) as pool:
+        for row in pool.imap_unordered(run_config_args, [(run, seed, config, out_dir) for run, seed, config in runs]):
+            rows.append(row)
+            results.write(json.dumps(row) + "\n")
+            results.flush()
+            outcome = f"error {row['error']}" if "error" in row else f"default_fitness={row['default_fitness']:.6f}"
+            print(f"run {row['run']} done in {row['wall_seconds']:.1f}s ({len(rows)}/{len(runs)}): {outcome}")
+
+    rows = write_table(rows, os.path.join(out_dir, "results.csv"))
+    print_table(rows, varied)
+    return 1 if all("error" in row for row in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
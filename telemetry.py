@@ -0,0 +1,189 @@
+"""
+Where a generation's time goes, one JSON line per generation
+
+Telemetry keeps a stopwatch per phase of the generation (evaluation, IPC, selection, breeding/mutation, cache upkeep, ...),
+and every task sent to the Pool goes through timed_call, which reports back how long the worker actually spent on it and which
+process it was. From that, evaluation is the worker time spread over the workers (what it would have taken perfectly balanced
+with nothing to send anywhere) and ipc is whatever else the Pool took: pickling, queueing, and workers sat waiting on the slowest one.
+New worker pids turning up are workers the Pool restarted (maxtasksperchild).
+
+One generation can be put under cProfile too, the main process and each task, the files are written to profile_dir
+and can be read together with pstats.Stats(*paths)
+
+Telemetry("telemetry.jsonl", profile_generation=5)
+"""
+import cProfile
+import json
+import os
+import time
+from contextlib import contextmanager
+
+try:
+    import resource # not on Windows, the RSS numbers just get left out there
+except ImportError:
+    resource = None
+
+PHASES = ("evaluation", "ipc", "selection", "breeding", "surrogate", "cache", "diversity", "checkpoint")
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process, and of the biggest of its children that have finished"""
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return {
+        "main": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def timed_call(func, args, profile_path=None):
+    """Runs func(*args) on a worker, returns (result, seconds it took, worker pid)"""
+    start = time.perf_counter()
+    if profile_path is None:
+        result = func(*args)
+    else:
+        profiler = cProfile.Profile()
+        result = profiler.runcall(func, *args)
+        profiler.dump_stats(profile_path)
+    return result, time.perf_counter() - start, os.getpid()
+
+
+class NoTelemetry:
+    """Stands in when nothing's being recorded, so the GA doesn't have to check"""
+
+    def start_generation(self, generation, workers):
+        pass
+
+    def end_generation(self, cache_stats=None, **fields):
+        pass
+
+    @contextmanager
+    def phase(self, name):
+        yield
+
+    def starmap(self, pool, func, iterable):
+        return pool.starmap(func, iterable)
+
+    def count(self, **counts):
+        pass
+
+
+NO_TELEMETRY = NoTelemetry()
+
+
+class Telemetry(NoTelemetry):
+    def __init__(self, path, profile_generation=None, profile_dir="profiles"):
+        """Appends a line to path for every generation
+        profile_generation is the number of the generation to run under cProfile (None for none)"""
+        self.path = path
+        self.profile_generation = profile_generation
+        self.profile_dir = profile_dir
+        self.file = open(path, "a", encoding="utf-8")
+        self.known_pids = set()
+        self.workers = None
+        self.restarts = 0
+        self.generation = None
+        self.profiler = None
+
+    def start_generation(self, generation, workers):
+        self.generation = generation
+        self.workers = workers
+        self.started = time.perf_counter()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.worker_seconds = 0.0
+        self.tasks = 0
+        self.counts = {}
+        self.profile_paths = []
+        if generation == self.profile_generation:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start
+
+    def starmap(self, pool, func, iterable):
+        """pool.starmap(func, iterable), with the time split between evaluation and ipc"""
+        tasks = []
+        for i, args in enumerate(iterable):
+            profile_path = None
+            if self.profiler is not None:
+                profile_path = os.path.join(self.profile_dir, f"generation_{self.generation}_{func.__name__}_{i}.prof")
+                self.profile_paths.append(profile_path)
+            tasks.append((func, args, profile_path))
+        if not tasks:
+            return []
+
+        start = time.perf_counter()
+        outcomes = pool.starmap(timed_call, tasks)
+        elapsed = time.perf_counter() - start
+
+        worker_seconds = sum(seconds for _, seconds, _ in outcomes)
+        # evaluation can't take less than the work spread evenly, or more than the whole call
+        evaluation = min(elapsed, worker_seconds / max(1, self.workers or 1))
+        self.phases["evaluation"] += evaluation
+        self.phases["ipc"] += elapsed - evaluation
+        self.worker_seconds += worker_seconds
+        self.tasks += len(tasks)
+
+        pids = {pid for _, _, pid in outcomes}
+        self.known_pids |= pids
+        return [result for result, _, _ in outcomes]
+
+    def count(self, **counts):
+        """Adds to this generation's counts (duplicates, cache hits, ...), written out alongside the phases"""
+        for name, value in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def worker_restarts(self):
+        """Restarts so far, every pid past the number of workers is a worker that replaced one"""
+        restarts = max(0, len(self.known_pids) - (self.workers or 0))
+        new, self.restarts = restarts - self.restarts, restarts
+        return new
+
+    def end_generation(self, cache_stats=None, **fields):
+        """Writes the generation's line, fields (best, avg, ...) go in as they are"""
+        if self.profiler is not None:
+            self.profiler.disable()
+            path = os.path.join(self.profile_dir, f"generation_{self.generation}_main.prof")
+            self.profiler.dump_stats(path)
+            self.profile_paths.insert(0, path)
+            self.profiler = None
+
+        wall = time.perf_counter() - self.started
+        phases = {name: round(seconds, 6) for name, seconds in self.phases.items()}
+        phases["other"] = round(max(0.0, wall - sum(self.phases.values())), 6)
+        record = {
+            "generation": self.generation,
+            "time": time.time(),
+            "wall_seconds": round(wall, 6),
+            "phases": phases,
+            "worker_seconds": round(self.worker_seconds, 6),
+            "tasks": self.tasks,
+            "counts": self.counts,
+            "workers": self.workers,
+            "worker_restarts": self.worker_restarts(),
+            "peak_rss_mb": peak_rss_mb(),
+        }
+        if cache_stats is not None:
+            record["cache"] = {key: cache_stats[key] for key in ("hits", "misses", "hit_rate", "evictions", "entries", "load") if key in cache_stats}
+        if self.profile_paths:
+            record["profiles"] = self.profile_paths
+        record.update(fields)
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
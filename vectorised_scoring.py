@@ -0,0 +1,288 @@
+"""
+The same coverage/conflict scoring as layout_fitness_measurer.score_layout, but with the corpus turned into integer arrays once
+so that scoring an individual is gathers and groupings in numpy rather than walking dicts of combo strings
+"""
+import numpy as np
+
+
+class CorpusArrays:
+    def __init__(self, split_left, split_vowel, split_right, split_pron, pron_weight, word_prob, word_start,
+                 pron_ids, left_ids, right_ids, vowel_ids):
+        """Every split as integer ids (split_*), each pronunciation's weight,
+        and each pronunciation's word probabilities laid out back to back, pronunciation i owns word_prob[word_start[i]:word_start[i+1]]
+        The *_ids dicts go from the strings to those ids"""
+        self.split_left = split_left
+        self.split_vowel = split_vowel
+        self.split_right = split_right
+        self.split_pron = split_pron
+        self.pron_weight = pron_weight
+        self.word_prob = word_prob
+        self.word_start = word_start
+        self.pron_ids = pron_ids
+        self.left_ids = left_ids
+        self.right_ids = right_ids
+        self.vowel_ids = vowel_ids
+
+        # The splits grouped by cluster, so I can find every split a cluster shows up in without scanning them all
+        # cluster i's splits are splits_by_left[left_start[i]:left_start[i] + left_count[i]]
+        self.splits_by_left = np.argsort(self.split_left, kind="stable")
+        self.left_count = np.bincount(self.split_left, minlength=len(self.left_ids))
+        self.left_start = np.cumsum(self.left_count) - self.left_count
+        self.splits_by_right = np.argsort(self.split_right, kind="stable")
+        self.right_count = np.bincount(self.split_right, minlength=len(self.right_ids))
+        self.right_start = np.cumsum(self.right_count) - self.right_count
+
+    @classmethod
+    def from_splits(cls, splits, pron_freqs, to_prob):
+        """splits are the (left cluster, vowel, right cluster, pronunciation, weight) tuples from build_vowel_splits
+        to_prob converts the zipf frequencies in pron_freqs, so the word probabilities come out exactly as score_layout has them"""
+        pron_ids = {pron: i for i, pron in enumerate(pron_freqs)}
+        left_ids = {}
+        right_ids = {}
+        vowel_ids = {}
+
+        left, vowel, right, pron = [], [], [], []
+        pron_weight = np.zeros(len(pron_ids))
+        for left_part, ph, right_part, p, weight in splits:
+            left.append(left_ids.setdefault(left_part, len(left_ids)))
+            vowel.append(vowel_ids.setdefault(ph, len(vowel_ids)))
+            right.append(right_ids.setdefault(right_part, len(right_ids)))
+            pron.append(pron_ids[p])
+            pron_weight[pron_ids[p]] = weight
+
+        word_prob = []
+        word_start = [0]
+        for word_freqs in pron_freqs.values():
+            word_prob.extend(to_prob(z) for z in word_freqs.values())
+            word_start.append(len(word_prob))
+
+        return cls(
+            np.array(left, dtype=np.int64), np.array(vowel, dtype=np.int64),
+            np.array(right, dtype=np.int64), np.array(pron, dtype=np.int64),
+            pron_weight, np.array(word_prob), np.array(word_start, dtype=np.int64),
+            pron_ids, left_ids, right_ids, vowel_ids
+        )
+
+    def top_pronunciations(self, count):
+        """The same corpus cut down to the splits of the count pronunciations with the most likely words (ids stay the same)
+        Every word left out is no more likely than the most likely word of any pronunciation kept, so adding the rest back
+        can only add losing words to a combo, never take them away: conflict on this is a lower bound on the full conflict"""
+        best_word = np.maximum.reduceat(self.word_prob, self.word_start[:-1])
+        kept = np.zeros(len(self.pron_weight), dtype=bool)
+        kept[np.argsort(-best_word, kind="stable")[:count]] = True
+        splits = np.flatnonzero(kept[self.split_pron])
+        return CorpusArrays(
+            self.split_left[splits], self.split_vowel[splits], self.split_right[splits], self.split_pron[splits],
+            self.pron_weight, self.word_prob, self.word_start,
+            self.pron_ids, self.left_ids, self.right_ids, self.vowel_ids
+        )
+
+    def pair_coverage(self, left_pairs, right_pairs):
+        """Exactly the coverage score_rows would give, without the join: a split is typed as soon as both its clusters
+        have a mask, whichever masks they are"""
+        left_typed = np.zeros(len(self.left_ids), dtype=bool)
+        left_typed[left_pairs[0]] = True
+        right_typed = np.zeros(len(self.right_ids), dtype=bool)
+        right_typed[right_pairs[0]] = True
+        covered = np.zeros(len(self.pron_weight), dtype=bool)
+        covered[self.split_pron[left_typed[self.split_left] & right_typed[self.split_right]]] = True
+        return float(self.pron_weight[covered].sum())
+
+    def cluster_pairs(self, masks, cluster_ids):
+        """Flip {mask: [clusters]} into (cluster id, integer mask) arrays sorted by cluster id
+        Clusters that never come up in the corpus are dropped, and the empty cluster goes on the blank mask"""
+        clusters, mask_ints = [], []
+        if "" in cluster_ids:
+            clusters.append(cluster_ids[""])
+            mask_ints.append(0)
+        for mask, chords in masks.items():
+            mask_int = int(mask, 2)
+            for chord in chords:
+                cluster_id = cluster_ids.get(chord)
+                if cluster_id is not None:
+                    clusters.append(cluster_id)
+                    mask_ints.append(mask_int)
+
+        clusters = np.array(clusters, dtype=np.int64)
+        mask_ints = np.array(mask_ints, dtype=np.int64)
+        order = np.argsort(clusters, kind="stable")
+        return clusters[order], mask_ints[order]
+
+    def match_rows(self, left_masks, right_masks):
+        """Every (split, left mask, right mask) that types a pronunciation, as three parallel arrays"""
+        return self.match_pairs(
+            self.cluster_pairs(left_masks, self.left_ids),
+            self.cluster_pairs(right_masks, self.right_ids)
+        )
+
+    def match_pairs(self, left_pairs, right_pairs, splits=None):
+        """match_rows, starting from the cluster_pairs of each bank, optionally only for some of the splits"""
+        left_clusters, left_mask_ints = left_pairs
+        right_clusters, right_mask_ints = right_pairs
+        if splits is None:
+            splits = np.arange(len(self.split_left))
+
+        rows, left_pick = join(self.split_left[splits], left_clusters, len(self.left_ids))
+        split = splits[rows]
+        right_rows, right_pick = join(self.split_right[split], right_clusters, len(self.right_ids))
+
+        return split[right_rows], left_mask_ints[left_pick[right_rows]], right_mask_ints[right_pick]
+
+    def match_batch(self, left_pairs, right_pairs):
+        """match_pairs for a whole batch of individuals at once, left_pairs and right_pairs have each one's cluster_pairs
+        Returns (owner, split, left mask, right mask), owner being which individual in the batch the row belongs to
+
+        Every individual's clusters are offset by its place in the batch, so the batch is just one bigger individual
+        with its own cluster ids, and it all goes through the same two joins"""
+        batch_size = len(left_pairs)
+        left = batch_pairs(left_pairs)
+        right = batch_pairs(right_pairs)
+
+        # Start from whichever side's clusters show up in fewer splits, the other side only has to be looked up for those
+        left_rows = int(self.left_count[left[1]].sum())
+        right_rows = int(self.right_count[right[1]].sum())
+        if left_rows <= right_rows:
+            owner, split, left_mask, right_mask = self.batch_join(
+                left, right, self.splits_by_left, self.left_start, self.left_count, self.split_right, len(self.right_ids), batch_size)
+        else:
+            owner, split, right_mask, left_mask = self.batch_join(
+                right, left, self.splits_by_right, self.right_start, self.right_count, self.split_left, len(self.left_ids), batch_size)
+        return owner, split, left_mask, right_mask
+
+    @staticmethod
+    def batch_join(first, second, splits_by_first, first_start, first_count, split_second, second_id_count, batch_size):
+        """Every split each individual's first side clusters show up in, then whichever of that individual's
+        second side pairs have the split's other cluster. Returns (owner, split, first mask, second mask)"""
+        first_owner, first_clusters, first_masks = first
+        second_owner, second_clusters, second_masks = second
+
+        start = first_start[first_clusters]
+        rows, pick = join_ranges(start, start + first_count[first_clusters])
+        split = splits_by_first[pick]
+        owner = first_owner[rows]
+
+        # each individual's pairs are sorted by cluster, and the individuals are in order, so the offset keys are sorted too
+        second_rows, second_pick = join(
+            owner * second_id_count + split_second[split],
+            second_owner * second_id_count + second_clusters,
+            batch_size * second_id_count
+        )
+        return owner[second_rows], split[second_rows], first_masks[rows[second_rows]], second_masks[second_pick]
+
+    def score_batch(self, batch_size, owner, split, left_mask, right_mask):
+        """score_rows for the rows from match_batch, (coverage_probs, conflict_probs) as arrays with one per individual"""
+        coverage = np.zeros(batch_size)
+        conflict = np.zeros(batch_size)
+        if len(split) == 0:
+            return coverage, conflict
+
+        pron = self.split_pron[split]
+        pron_count = len(self.pron_weight)
+
+        # Coverage: a population x pronunciation matrix of what's been typed, every pronunciation counts once per individual
+        covered = np.zeros((batch_size, pron_count), dtype=bool)
+        covered[owner, pron] = True
+        coverage = covered @ self.pron_weight
+
+        # Combos get the owner squashed in as well, so two individuals typing the same combo don't count as a conflict
+        left_size = int(left_mask.max()) + 1
+        right_size = int(right_mask.max()) + 1
+        combo = ((owner * left_size + left_mask) * len(self.vowel_ids) + self.split_vowel[split]) * right_size + right_mask
+        _, group, counts = np.unique(combo, return_inverse=True, return_counts=True)
+
+        # Conflict: same as score_rows, with the losing words added up per owner at the end
+        ambiguous = counts[group] > 1
+        pron = pron[ambiguous]
+        group = group[ambiguous]
+        owner = owner[ambiguous]
+        if len(pron) == 0:
+            return coverage, conflict
+
+        word_rows, word_pick = join_ranges(self.word_start[pron], self.word_start[pron + 1])
+        group = group[word_rows]
+        prob = self.word_prob[word_pick]
+
+        group_max = np.full(len(counts), -np.inf)
+        np.maximum.at(group_max, group, prob)
+        losing = prob < group_max[group]
+        conflict = np.bincount(owner[word_rows][losing], weights=prob[losing], minlength=batch_size)
+
+        return coverage, conflict
+
+    def splits_touching(self, left_clusters=(), right_clusters=()):
+        """Every split that has one of the given left or right clusters, in order
+        Clusters the corpus never uses are ignored"""
+        left = np.array([self.left_ids[c] for c in left_clusters if c in self.left_ids], dtype=np.int64)
+        right = np.array([self.right_ids[c] for c in right_clusters if c in self.right_ids], dtype=np.int64)
+
+        touched = np.zeros(len(self.split_left), dtype=bool)
+        _, left_pick = join_ranges(self.left_start[left], self.left_start[left] + self.left_count[left])
+        touched[self.splits_by_left[left_pick]] = True
+        _, right_pick = join_ranges(self.right_start[right], self.right_start[right] + self.right_count[right])
+        touched[self.splits_by_right[right_pick]] = True
+        return np.flatnonzero(touched)
+
+    def score(self, left_masks, right_masks):
+        """Returns (coverage_prob, conflict_prob) for the given mask tables
+        Goes through the batch path as a batch of one, since that starts from whichever side is cheaper to join"""
+        pairs = ([self.cluster_pairs(left_masks, self.left_ids)], [self.cluster_pairs(right_masks, self.right_ids)])
+        coverage, conflict = self.score_batch(1, *self.match_batch(*pairs))
+        return float(coverage[0]), float(conflict[0])
+
+    def score_rows(self, split, left_mask, right_mask):
+        """Returns (coverage_prob, conflict_prob) for the rows from match_rows"""
+        if len(split) == 0:
+            return 0.0, 0.0
+
+        pron = self.split_pron[split]
+
+        # Coverage: every pronunciation counts once, however many combos type it
+        covered = np.zeros(len(self.pron_weight), dtype=bool)
+        covered[pron] = True
+        coverage = float(self.pron_weight[covered].sum())
+
+        # A combo is the left mask, the vowel and the right mask squashed into one integer
+        right_size = int(right_mask.max()) + 1
+        combo = (left_mask * len(self.vowel_ids) + self.split_vowel[split]) * right_size + right_mask
+        _, group, counts = np.unique(combo, return_inverse=True, return_counts=True)
+
+        # Conflict: only combos typing more than one pronunciation, where everything but the most likely word loses
+        ambiguous = counts[group] > 1
+        pron = pron[ambiguous]
+        group = group[ambiguous]
+        if len(pron) == 0:
+            return coverage, 0.0
+
+        word_rows, word_pick = join_ranges(self.word_start[pron], self.word_start[pron + 1])
+        group = group[word_rows]
+        prob = self.word_prob[word_pick]
+
+        group_max = np.full(len(counts), -np.inf)
+        np.maximum.at(group_max, group, prob)
+        conflict = float(prob[prob < group_max[group]].sum())
+
+        return coverage, conflict
+
+
+def batch_pairs(pairs):
+    """A list of cluster_pairs, one per individual, as (owner, cluster ids, integer masks) for the whole batch"""
+    owner = np.repeat(np.arange(len(pairs)), [len(clusters) for clusters, _ in pairs])
+    clusters = np.concatenate([clusters for clusters, _ in pairs])
+    mask_ints = np.concatenate([mask_ints for _, mask_ints in pairs])
+    return owner, clusters, mask_ints
+
+
+def join_ranges(start, end):
+    """For rows that each own the range start:end, every (row, position) pair"""
+    counts = end - start
+    rows = np.repeat(np.arange(len(start)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return rows, np.repeat(start, counts) + offsets
+
+
+def join(keys, sorted_keys, id_count):
+    """For every key, every position in sorted_keys holding the same value, as (index into keys, index into sorted_keys)
+    The keys are ids below id_count, so each id's run in sorted_keys can be looked up directly rather than searched for"""
+    counts = np.bincount(sorted_keys, minlength=id_count)
+    starts = np.cumsum(counts) - counts
+    return join_ranges(starts[keys], starts[keys] + counts[keys])